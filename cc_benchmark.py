@@ -0,0 +1,51 @@
+from lstore.db import Database
+from lstore.query import Query
+from lstore.transaction import Transaction
+
+from random import randint, sample, seed
+from time import perf_counter
+
+# compares the concurrency control modes on the same workload at different contention
+# levels: every transaction reads and rewrites a few records picked from a hot set,
+# the smaller the hot set the more transactions fight over the same records
+# 'batch' is the deterministic scheduler (Database.run_batch) next to the three modes
+
+number_of_records = 10000
+number_of_transactions = 2000
+operations_per_transaction = 4
+num_threads = 8
+hot_set_sizes = [10000, 1000, 100, 10]
+modes = ['2pl', 'occ', 'si', 'batch']
+
+
+def build_workload(query, table, hot):
+    transactions = []
+    for i in range(number_of_transactions):
+        t = Transaction()
+        for key in sample(range(hot), operations_per_transaction):
+            t.add_query(query.select, table, key, 0, [1, 1, 1, 1, 1])
+            t.add_query(query.update, table, key, None, randint(0, 1000), None, None, None)
+        transactions.append(t)
+    return transactions
+
+
+print('%-6s %-6s %10s %8s %8s %8s %12s' % ('hot', 'mode', 'txn/s', 'commits', 'aborts', 'retries', 'avg lat ms'))
+for hot in hot_set_sizes:
+    for mode in modes:
+        seed(3562901)
+        db = Database()
+        table = db.create_table('Bench', 5, 0)
+        query = Query(table)
+        for key in range(number_of_records):
+            query.insert(key, randint(0, 1000), randint(0, 1000), randint(0, 1000), randint(0, 1000))
+        transactions = build_workload(query, table, hot)
+        start = perf_counter()
+        if mode == 'batch':
+            stats = db.run_batch(transactions, num_threads)
+            stats['retries'] = 0
+        else:
+            stats = db.run_transactions(transactions, num_threads, mode=mode)
+        elapsed = perf_counter() - start
+        lat = '%.3f' % (stats['avg_latency'] * 1000) if 'avg_latency' in stats else '-'
+        print('%-6d %-6s %10.0f %8d %8d %8d %12s' % (hot, mode, number_of_transactions / elapsed,
+              stats['commits'], stats['aborts'], stats['retries'], lat))
@@ -0,0 +1,130 @@
+import threading
+from random import Random
+
+from lstore.db import Database
+from lstore.query import Query
+from lstore.transaction import Transaction
+from lstore.transaction_worker import TransactionWorker
+
+# strict 2PL: deletes and inserts of the same primary key from concurrent transactions
+# first two fixed interleavings where one transaction is held open halfway through, then
+# worker threads hammering a handful of keys, no key may ever end up with two records and
+# no transaction may change a record another one hasnt committed yet
+
+db = Database()
+grades_table = db.create_table('Grades', 5, 0)
+query = Query(grades_table)
+grades_table.index.create_index(2)
+for key in range(1, 11):
+    query.insert(key, key, key, key, key)
+
+score = 0
+total = 0
+
+
+# a query that holds its transaction open until released, it reads an unrelated key so
+# the only locks it adds are shared ones nobody else asks for
+class Pause:
+    def __init__(self):
+        self.reached = threading.Event()
+        self.release = threading.Event()
+
+    def select(self, search_key, search_key_index, projected_columns_index):
+        self.reached.set()
+        self.release.wait()
+        return []
+
+
+def hold_open(queries):
+    pause = Pause()
+    t = Transaction()
+    for q in queries:
+        t.add_query(q[0], grades_table, *q[1:])
+    t.add_query(pause.select, grades_table, 10, 0, [1, 1, 1, 1, 1])
+    # and then fail, so everything it did gets rolled back
+    t.add_query(query.update, grades_table, -1, None, 1, None, None, None)
+    th = threading.Thread(target=t.run)
+    th.start()
+    pause.reached.wait()
+    return pause, th
+
+
+def run(*queries):
+    t = Transaction()
+    for q in queries:
+        t.add_query(q[0], grades_table, *q[1:])
+    return t.run()
+
+
+def expect(label, ok):
+    global score, total
+    total += 1
+    if ok:
+        score += 1
+    else:
+        print(label, 'failed')
+
+
+# 1: a delete still open, somebody inserts the same key, the delete rolls back
+pause, th = hold_open([(query.delete, 1)])
+expect('insert over an uncommitted delete was refused', not run((query.insert, 1, 7, 7, 7, 7)))
+expect('select of a key with an uncommitted delete was refused', not run((query.select, 1, 0, [1, 1, 1, 1, 1])))
+pause.release.set()
+th.join()
+result = [r.columns for r in query.select(1, 0, [1, 1, 1, 1, 1])]
+expect('one record for key 1 after the rollback', result == [[1, 1, 1, 1, 1]])
+expect('one index entry for key 1', len(grades_table.index.locate(0, 1)) == 1)
+
+# 2: an insert still open, somebody updates it or finds it through another column
+pause, th = hold_open([(query.insert, 50, 5, 123, 5, 5)])
+expect('update of an uncommitted insert was refused', not run((query.update, 50, None, 9, None, None, None)))
+expect('delete of an uncommitted insert was refused', not run((query.delete, 50)))
+expect('select by column 2 of an uncommitted insert was refused', not run((query.select, 123, 2, [1, 1, 1, 1, 1])))
+pause.release.set()
+th.join()
+expect('rolled back insert is gone', query.select(50, 0, [1, 1, 1, 1, 1]) == [])
+expect('rolled back insert left no index entry', query.select(123, 2, [1, 1, 1, 1, 1]) == [])
+expect('no locks left behind', grades_table.lock_manager.num_locked() == 0)
+print("Interleavings finished")
+
+# 3: workers deleting and reinserting the same few keys, some transactions fail on purpose
+hot_keys = list(range(100, 110))
+for key in hot_keys:
+    query.insert(key, 0, key % 3, 0, 0)
+workers = [TransactionWorker() for _ in range(8)]
+for w, worker in enumerate(workers):
+    rnd = Random(w)
+    for i in range(300):
+        key = rnd.choice(hot_keys)
+        t = Transaction()
+        op = rnd.randrange(4)
+        if op == 0:
+            t.add_query(query.delete, grades_table, key)
+            t.add_query(query.insert, grades_table, key, w, key % 3, i, 0)
+        elif op == 1:
+            t.add_query(query.delete, grades_table, key)
+        elif op == 2:
+            t.add_query(query.insert, grades_table, key, w, key % 3, i, 0)
+        else:
+            t.add_query(query.delete, grades_table, key)
+            t.add_query(query.insert, grades_table, key, w, key % 3, i, 0)
+            t.add_query(query.update, grades_table, -1, None, 1, None, None, None)
+        worker.add_transaction(t)
+for worker in workers:
+    worker.run()
+for worker in workers:
+    worker.join()
+
+for key in hot_keys:
+    expect('at most one record for key %d' % key, len(query.select(key, 0, [1, 1, 1, 1, 1])) <= 1)
+    expect('at most one index entry for key %d' % key, len(grades_table.index.locate(0, key)) <= 1)
+live = sorted(rid for rid in grades_table.scan_rids(0, lambda v: v in hot_keys))
+indexed = sorted(rid for key in hot_keys for rid in grades_table.index.locate(0, key))
+expect('index matches the pages', live == indexed)
+present = sorted(key for key in hot_keys if query.select(key, 0, [1, 0, 0, 0, 0]))
+by_column = sorted(r.columns[0] for v in range(3) for r in query.select(v, 2, [1, 0, 0, 0, 0]) if r.columns[0] in hot_keys)
+expect('secondary index matches the pages', by_column == present)
+expect('no locks left behind', grades_table.lock_manager.num_locked() == 0)
+print("Workers finished")
+
+print('Score', score, '/', total)
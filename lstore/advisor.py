@@ -0,0 +1,157 @@
+import threading
+from lstore.config import INDEX_ENTRY_BYTES, ADVISOR_MEMORY_BUDGET, ADVISOR_MIN_LOOKUPS, ADVISOR_TUNE_INTERVAL
+
+"""
+# keeps track of which columns queries search on and how many rows that costs
+# and decides which non key columns deserve an index within a memory budget
+# in auto mode it creates/drops the indexes itself, builds run on a background thread
+"""
+class IndexAdvisor:
+    def __init__(self, table, memory_budget=ADVISOR_MEMORY_BUDGET):
+        self.table = table
+        self.memory_budget = memory_budget
+        self.min_lookups = ADVISOR_MIN_LOOKUPS
+        self.tune_interval = ADVISOR_TUNE_INTERVAL
+        self.lookups = [0] * table.num_columns
+        self.scans = [0] * table.num_columns
+        self.rows_scanned = [0] * table.num_columns
+        self.auto = False
+        self.auto_built = set()     # indexes we made ourselfs, only these get dropped
+        self.builds = {}            # col -> build thread
+        self._since_tune = 0
+        self._tune_lock = threading.Lock()
+
+    """
+    # Called by Query every time it looks up a column
+    :param col: int          # the column that was searched on
+    :param rows: int         # rows a scan of this column costs (whether or not one happened)
+    :param scanned: bool     # True if there was no index so we really scanned
+    """
+    def record(self, col, rows, scanned):
+        self.lookups[col] = self.lookups[col] + 1
+        self.rows_scanned[col] = self.rows_scanned[col] + rows
+        if scanned:
+            self.scans[col] = self.scans[col] + 1
+        if self.auto:
+            self._since_tune = self._since_tune + 1
+            if self._since_tune >= self.tune_interval:
+                self._since_tune = 0
+                self.tune()
+
+    """
+    # Estimated bytes for one secondary index over the current table
+    """
+    def index_bytes(self):
+        nrec = 0
+        for prange in self.table.page_ranges:
+            nrec = nrec + prange.num_base_records
+        return nrec * INDEX_ENTRY_BYTES
+
+    """
+    # Works out the set of non key columns that should be indexed
+    # indexes the user made themselfs are kept and eat into the budget first,
+    # then the hottest columns (by rows a scan would touch) get picked greedily
+    """
+    def _target(self):
+        idx = self.table.index
+        cost = self.index_bytes()
+        left = self.memory_budget
+        target = []
+        for col in range(self.table.num_columns):
+            if col == self.table.key or col in self.auto_built:
+                continue
+            if idx.maintained(col):
+                target.append(col)
+                left = left - cost
+        cands = []
+        for col in range(self.table.num_columns):
+            if col == self.table.key or col in target:
+                continue
+            if self.lookups[col] < self.min_lookups:
+                continue
+            cands.append((self.rows_scanned[col], col))
+        cands.sort(reverse=True)
+        for _, col in cands:
+            if cost > left:
+                break
+            target.append(col)
+            left = left - cost
+        return target
+
+    """
+    # Returns the columns that should get an index but dont have one yet, hottest first
+    """
+    def recommend(self):
+        idx = self.table.index
+        return [col for col in self._target() if not idx.maintained(col)]
+
+    """
+    # Per column numbers so you can see why the advisor picked what it did
+    """
+    def report(self):
+        idx = self.table.index
+        out = []
+        for col in range(self.table.num_columns):
+            out.append({
+                'column': col,
+                'lookups': self.lookups[col],
+                'scans': self.scans[col],
+                'rows_scanned': self.rows_scanned[col],
+                'indexed': idx.indices[col] is not None,
+                'auto': col in self.auto_built,
+            })
+        return out
+
+    """
+    # Makes the indexes match the target set: drops cold auto indexes and starts
+    # background builds for the new ones, then halves the counters so old traffic fades out
+    """
+    def tune(self):
+        if not self._tune_lock.acquire(blocking=False):
+            return []
+        try:
+            idx = self.table.index
+            target = self._target()
+            for col in list(self.auto_built):
+                if col not in target:
+                    idx.drop_index(col)
+                    self.auto_built.discard(col)
+                    self.builds.pop(col, None)
+            started = []
+            for col in target:
+                if idx.maintained(col):
+                    continue
+                th = idx.create_index(col, background=True)
+                if th is not None:
+                    self.builds[col] = th
+                    self.auto_built.add(col)
+                    started.append(col)
+            for col in range(self.table.num_columns):
+                self.lookups[col] = self.lookups[col] // 2
+                self.scans[col] = self.scans[col] // 2
+                self.rows_scanned[col] = self.rows_scanned[col] // 2
+            return started
+        finally:
+            self._tune_lock.release()
+
+    """
+    # Turns on automatic tuning
+    :param memory_budget: int     # bytes allowed for secondary indexes, None keeps the current one
+    :param interval: int          # lookups between tuning passes, None keeps the current one
+    """
+    def enable_auto(self, memory_budget=None, interval=None):
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        if interval is not None:
+            self.tune_interval = interval
+        self.auto = True
+
+    def disable_auto(self):
+        self.auto = False
+
+    """
+    # Waits for any background index builds to finish
+    """
+    def join(self):
+        for th in list(self.builds.values()):
+            th.join()
@@ -1,4 +1,5 @@
 import os
+import threading
 from collections import OrderedDict
 from lstore.page import Page, write_page_to_disk, read_page_from_disk
 from lstore.config import BUFFERPOOL_CAPACITY
@@ -16,6 +17,15 @@ class BufferPool:
         self.dirty = set()
         self.pin_counts = {}
         self._made_dirs = set()
+        # transaction workers share the pool, every structural change happens under this
+        self.lock = threading.Lock()
+        # with a write ahead log on, dirty pages only reach the disk through checkpoints
+        self.no_steal = False
+        # pages a running checkpoint has copied but not written yet, they stay in memory
+        self.flushing = set()
+        # called when nothing can be evicted, the database points it at its checkpointer
+        # so the dirty pages no steal is holding on to become evictable again
+        self.on_full = None
 
     # builds filepath for a page from its id tuple
     def _page_filepath(self, page_id):
@@ -25,6 +35,10 @@ class BufferPool:
 
     # grab page from cache or load from disk, pin it
     def get_page(self, pid):
+        with self.lock:
+            return self._get_page(pid)
+
+    def _get_page(self, pid):
         if pid in self.pages:
             self.pages.move_to_end(pid)
             n = self.pin_counts.get(pid, 0)
@@ -36,8 +50,9 @@ class BufferPool:
         if pg is None:
             pg = Page()
 
-        while len(self.pages) >= self.capacity:
-            self._evict()
+        # if nothing can go the pool runs over capacity until a checkpoint frees pages
+        while len(self.pages) >= self.capacity and self._evict():
+            pass
 
         self.pages[pid] = pg
         self.pages.move_to_end(pid)
@@ -59,33 +74,92 @@ class BufferPool:
     def mark_dirty(self, pid):
         self.dirty.add(pid)
 
+    # writes one value into a page and marks it dirty, holding the lock instead of a pin
+    # so the page cant be evicted halfway through
+    def write_value(self, pid, slot, value):
+        with self.lock:
+            pg = self.pages.get(pid)
+            if pg is None:
+                pg = self._get_page(pid)
+                n = self.pin_counts[pid] - 1
+                if n <= 0:
+                    del self.pin_counts[pid]
+                else:
+                    self.pin_counts[pid] = n
+            else:
+                self.pages.move_to_end(pid)
+            pg.write_at(slot, value)
+            if pg.num_records <= slot:
+                pg.num_records = slot + 1
+            self.dirty.add(pid)
+
     # removes a page from the pinned pages
     def unpin(self, pid):
-        if pid not in self.pin_counts:
-            return
-        n = self.pin_counts[pid] - 1
-        self.pin_counts[pid] = n
-        if n <= 0:
-            del self.pin_counts[pid]
+        with self.lock:
+            if pid not in self.pin_counts:
+                return
+            n = self.pin_counts[pid] - 1
+            self.pin_counts[pid] = n
+            if n <= 0:
+                del self.pin_counts[pid]
 
     # writes all dirty pages to disk
     def flush_all(self):
-        dirty_list = [x for x in self.dirty]
-        for pid in dirty_list:
-            self._flush_page(pid)
-        self.dirty.clear()
+        with self.lock:
+            dirty_list = [x for x in self.dirty]
+            for pid in dirty_list:
+                self._flush_page(pid)
+            self.dirty.clear()
 
-    # kick out least recently used unpinned page
+    # copies of every dirty page as (pid, num_records, bytes) for a checkpoint, the pages
+    # count as clean from here on so a write made while the checkpoint is being written
+    # dirties them again for the next one, until end_flush they cant be evicted
+    def dirty_snapshot(self):
+        with self.lock:
+            snap = [(pid, self.pages[pid].num_records, bytes(self.pages[pid].data)) for pid in self.dirty if pid in self.pages]
+            for pid, _, _ in snap:
+                self.flushing.add(pid)
+                self.dirty.discard(pid)
+            return snap
+
+    """
+    # Called once a checkpoint is done with the pages it copied, if it failed they are
+    # marked dirty again so the next one picks them up
+    :param pids: list     # the pages dirty_snapshot handed out
+    :param ok: bool       # whether they made it to disk
+    """
+    def end_flush(self, pids, ok=True):
+        with self.lock:
+            for pid in pids:
+                self.flushing.discard(pid)
+                if not ok:
+                    self.dirty.add(pid)
+            # back down to capacity if we ran over while waiting for this
+            while len(self.pages) > self.capacity and self._evict():
+                pass
+
+    # writes a page image straight to its file, used when a checkpoint gets applied
+    def write_raw(self, pid, num_records, data):
+        pg = Page()
+        pg.num_records = num_records
+        pg.data = bytearray(data)
+        pth = self._page_filepath(pid)
+        os.makedirs(os.path.dirname(pth), exist_ok=True)
+        write_page_to_disk(pg, pth, sync=True)
+
+    # kick out least recently used unpinned page, False if there is none we can drop
     def _evict(self):
         for pid in self.pages:
-            if pid not in self.pin_counts:
+            if pid not in self.pin_counts and pid not in self.flushing and not (self.no_steal and pid in self.dirty):
                 if pid in self.dirty:
                     self._flush_page(pid)
                     self.dirty.discard(pid)
                 del self.pages[pid]
-                return
-        # everything pinned, just bump capcity
-        self.capacity = self.capacity + 1
+                return True
+        # everything pinned (or dirty under no steal), ask for a checkpoint
+        if self.on_full is not None:
+            self.on_full()
+        return False
 
     # writes all dirty pages to disk
     def _load_from_disk(self, pid):
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from lstore.config import ROW_CACHE_CAPACITY, VERSION_CACHE_CAPACITY
+
+"""
+# caches the latest version of hot rows by primary key so selects on them skip the
+# page directory and bufferpool completely
+# LRU ordered dict like the bufferpool, writes refresh or drop the entry
+"""
+class RowCache:
+    def __init__(self, capacity=ROW_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.rows = OrderedDict()     # primary key -> (base rid, tuple of column values)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    # returns the cached (rid, values) or None, counts the hit/miss
+    def get(self, key):
+        with self._lock:
+            ent = self.rows.get(key)
+            if ent is None:
+                self.misses = self.misses + 1
+                return None
+            self.rows.move_to_end(key)
+            self.hits = self.hits + 1
+            return ent
+
+    # adds a row, kicking out the least recently used one when full
+    def put(self, key, ent):
+        with self._lock:
+            self.rows[key] = ent
+            self.rows.move_to_end(key)
+            while len(self.rows) > self.capacity:
+                self.rows.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    # write-through for updates, only rows already cached get the new values
+    def refresh(self, key, ent):
+        with self._lock:
+            if key in self.rows:
+                self.rows[key] = ent
+
+    # drops a row after a delete (or anything else that makes it wrong)
+    def invalidate(self, key):
+        with self._lock:
+            if self.rows.pop(key, None) is not None:
+                self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        with self._lock:
+            self.rows.clear()
+
+    # hit/miss numbers so you can tell if the cache is paying off
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self.rows),
+            'capacity': self.capacity,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+"""
+# keeps the version index (tail timestamps and rids) of the records read or written most
+# recently, an index that falls out gets rebuilt from the tail chain next time
+# whoever holds an entry may keep appending to it under the record latch, dropping it
+# here only means the next reader walks the chain again
+"""
+class VersionCache:
+    def __init__(self, capacity=VERSION_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()    # base rid -> ([timestamps], [tail rids])
+        self._lock = threading.Lock()
+
+    def get(self, rid):
+        with self._lock:
+            ent = self.entries.get(rid)
+            if ent is not None:
+                self.entries.move_to_end(rid)
+            return ent
+
+    def put(self, rid, ent):
+        with self._lock:
+            self.entries[rid] = ent
+            self.entries.move_to_end(rid)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def pop(self, rid, default=None):
+        with self._lock:
+            return self.entries.pop(rid, default)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,117 @@
+import threading
+from time import monotonic
+from lstore.config import CHECKPOINT_INTERVAL, CHECKPOINT_LOG_RECORDS, CHECKPOINT_POLL
+
+
+"""
+# lets writers through in parallel but can be shut for a moment so a checkpoint can copy
+# a state that matches a prefix of the log: while its shut no transaction is halfway
+# through its writes and every write made so far has its log record queued
+# writers are a transaction from its first write to its commit record, or a single query
+# outside any transaction, a thread already inside passes again without counting so the
+# queries a transaction runs (and its rollback) never wait on a checkpoint
+"""
+class WriteGate:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.active = 0
+        self.closed = False
+        self._local = threading.local()
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, *exc):
+        self.leave()
+        return False
+
+    def enter(self):
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        if depth:
+            return
+        with self.cond:
+            while self.closed:
+                self.cond.wait()
+            self.active = self.active + 1
+
+    def leave(self):
+        self._local.depth = self._local.depth - 1
+        if self._local.depth:
+            return
+        with self.cond:
+            self.active = self.active - 1
+            if self.closed and self.active == 0:
+                self.cond.notify_all()
+
+    # stops new writers and waits for the ones inside to finish
+    def close(self):
+        with self.cond:
+            while self.closed:
+                self.cond.wait()
+            self.closed = True
+            while self.active:
+                self.cond.wait()
+
+    def open(self):
+        with self.cond:
+            self.closed = False
+            self.cond.notify_all()
+
+
+"""
+# background thread that checkpoints a database every interval seconds, or sooner once
+# the log has grown by max_records since the last one, which is what bounds recovery time,
+# or right away when the bufferpool is full of dirty pages it isnt allowed to evict
+:param db: Database          # the database to checkpoint
+:param interval: float       # seconds between checkpoints
+:param max_records: int      # log records that force an early checkpoint
+"""
+class Checkpointer:
+    def __init__(self, db, interval=CHECKPOINT_INTERVAL, max_records=CHECKPOINT_LOG_RECORDS):
+        self.db = db
+        self.interval = interval
+        self.max_records = max_records
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()     # set to get a checkpoint right away
+        self.thread = None
+        self.count = 0
+        self.last_duration = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+
+    # asks for a checkpoint as soon as possible, safe to call holding any lock
+    def request(self):
+        self.wakeup.set()
+
+    # true once the log since the last checkpoint is long enough to force one
+    def _log_full(self):
+        wal = self.db.wal
+        return wal is not None and wal.next_lsn - 1 - self.db.checkpoint_lsn >= self.max_records
+
+    def _loop(self):
+        last = monotonic()
+        while True:
+            self.wakeup.wait(min(CHECKPOINT_POLL, self.interval))
+            if self.stop_event.is_set():
+                return
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+            elif monotonic() - last < self.interval and not self._log_full():
+                continue
+            start = monotonic()
+            self.db.checkpoint()
+            last = monotonic()
+            self.last_duration = last - start
+            self.count = self.count + 1
@@ -0,0 +1,52 @@
+import threading
+from time import time_ns
+
+"""
+# timestamps for TIMESTAMP_COLUMN: nanoseconds since the epoch, strictly increasing so two
+# versions never tie even when written in the same nanosecond
+# snapshot transactions pin one commit timestamp for all their writes, and take their
+# start timestamp under the commit lock so they never see half of a commit
+"""
+_lock = threading.Lock()
+_last = 0
+_local = threading.local()
+
+# held while a snapshot transaction validates and installs its writes
+commit_lock = threading.Lock()
+
+
+# next timestamp, or the pinned one if this thread is installing a commit
+def now():
+    global _last
+    ts = getattr(_local, 'ts', None)
+    if ts is not None:
+        return ts
+    t = time_ns()
+    with _lock:
+        if t <= _last:
+            t = _last + 1
+        _last = t
+    return t
+
+
+# start timestamp for a snapshot: everything committed before it is fully installed
+def snapshot():
+    with commit_lock:
+        return now()
+
+
+"""
+# Makes now() return one fixed timestamp on this thread while inside the with block
+:param ts: int      # the timestamp to hand out
+"""
+class pinned:
+    def __init__(self, ts):
+        self.ts = ts
+
+    def __enter__(self):
+        _local.ts = self.ts
+        return self.ts
+
+    def __exit__(self, *exc):
+        _local.ts = None
+        return False
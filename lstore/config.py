@@ -18,8 +18,68 @@ NUM_META_COLS = 4
 # 0 means no indirection / null pointer basicaly
 NULL_RID = 0
 
+# set in a base record's schema encoding once merge has copied its original values into a
+# tail record at the end of its chain, sits above any column bit
+ORIGINAL_SAVED = 1 << 62
+
 # bufferpool capcity
 BUFFERPOOL_CAPACITY = 10000
 
 # when to triger merge
 MERGE_THRESHOLD = 100000
+
+# index advisor, rough bytes one index entry costs (dict slot + rid list + ints)
+INDEX_ENTRY_BYTES = 120
+# how much memory the advisor can spend on secondary indexes
+ADVISOR_MEMORY_BUDGET = 64 * 1024 * 1024
+# a column needs at least this many lookups befor its worth indexing
+ADVISOR_MIN_LOOKUPS = 20
+# lookups between automatic tuning passes
+ADVISOR_TUNE_INTERVAL = 1000
+
+# how many primary keys one block of a column summary covers
+SUMMARY_BLOCK_KEYS = 512
+
+# range queries expected to hit more than this fraction of the table scan the pages
+# instead of probing the index and rebuilding records one rid at a time
+SCAN_SELECTIVITY_THRESHOLD = 0.2
+
+# number of striped record latches per table, records hash onto one by rid
+LATCH_STRIPES = 64
+
+# default number of rows the optional per table row cache holds
+ROW_CACHE_CAPACITY = 10000
+# how many records per table keep their version index in memory, the rest get rebuilt
+# from the tail chain when asked for
+VERSION_CACHE_CAPACITY = 100000
+
+# how many times a worker reruns an aborted transaction before giving up on it
+TXN_MAX_RETRIES = 10
+# first retry waits about this many seconds, doubling each time up to the cap
+TXN_BACKOFF_BASE = 0.001
+TXN_BACKOFF_MAX = 0.1
+# workers Database.run_transactions spreads a batch over when not told otherwise
+NUM_WORKERS = 8
+
+# shards in the lock table, resources hash onto one
+LOCK_SHARDS = 64
+# 'no_wait' aborts on any lock conflict, 'wait_die' lets older transactions wait
+LOCK_POLICY = 'no_wait'
+
+# write ahead log file inside the database directory
+WAL_FILE = 'wal.log'
+# a checkpoint is staged in here first so a crash halfway through can be finished on open
+CHECKPOINT_FILE = 'checkpoint.dw'
+# how long the log flusher waits to gather more commits into one fsync, 0 = right away
+WAL_GROUP_COMMIT_MS = 2
+# if False transactions dont wait for their commit record to hit the disk
+WAL_SYNC_COMMIT = True
+# seconds between the background checkpoints of an open database
+CHECKPOINT_INTERVAL = 60
+# log records since the last checkpoint that force the next one early, bounds recovery
+CHECKPOINT_LOG_RECORDS = 100000
+# how often the checkpoint thread looks at the clock and the log
+CHECKPOINT_POLL = 0.5
+# a table's metadata deltas get folded into a full table_meta.json once the directory
+# entries they carry pass this fraction of the directory
+CHECKPOINT_COMPACT_RATIO = 0.5
@@ -1,8 +1,41 @@
 import os
 import json
+import pickle
+import threading
 from lstore.table import Table, PageRange
+from lstore.query import Query
 from lstore.bufferpool import BufferPool
-from lstore.config import BUFFERPOOL_CAPACITY, NUM_META_COLS
+from lstore.transaction_worker import TransactionWorker
+from lstore.lock_manager import LockManager
+from lstore.wal import WriteAheadLog
+from lstore.checkpoint import WriteGate, Checkpointer
+from lstore.scheduler import BatchScheduler
+from lstore.config import BUFFERPOOL_CAPACITY, NUM_META_COLS, NUM_WORKERS, WAL_FILE, CHECKPOINT_FILE, CHECKPOINT_COMPACT_RATIO
+
+
+# writes a json file and makes sure it is on disk before returning
+def _write_json(pth, obj):
+    f = open(pth, 'w')
+    json.dump(obj, f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+
+# appends one json line and fsyncs it, a torn line a crash left at the end is cut off
+# first so the new one doesnt get glued onto it
+def _append_json_line(pth, obj):
+    f = open(pth, 'ab+')
+    end = f.seek(0, os.SEEK_END)
+    if end:
+        f.seek(end - 1)
+        if f.read(1) != b'\n':
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+    f.write((json.dumps(obj, separators=(',', ':')) + '\n').encode())
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
 
 
 """
@@ -15,72 +48,310 @@ class Database:
         self.tables = {}
         self.path = None
         self.bufferpool = BufferPool(BUFFERPOOL_CAPACITY)
+        self.lock_manager = LockManager()
+        self.wal = None
+        self.gate = WriteGate()         # writers pass it, a checkpoint shuts it to take its snapshot
+        self.checkpointer = None
+        self.checkpoint_lsn = 0
+        self._checkpoint_lock = threading.Lock()
+        # table name -> what its metadata files on disk hold: the table, its page range
+        # metadata, delta entries written since the last full table_meta.json and the
+        # generation of that file, so checkpoints can save just what changed
+        self._persisted = {}
 
     # loads up a database from disk, reads the metadata json and rebuilds all the tables
+    # then finishes a checkpoint a crash interrupted and replays the write ahead log past it,
+    # from then on a background thread checkpoints it every CHECKPOINT_INTERVAL seconds
     def open(self, path):
         self.path = path
         os.makedirs(path, exist_ok=True)
         self.bufferpool.db_path = path
+        self._finish_checkpoint()
+        lsn = self._load_meta()
+        self.checkpoint_lsn = lsn
+        self.wal = WriteAheadLog(os.path.join(path, WAL_FILE))
+        self._replay(self.wal.read(), lsn)
+        self.wal.start(lsn)
+        self.bufferpool.no_steal = True
+        for tbl in self.tables.values():
+            tbl.wal = self.wal
+            tbl.gate = self.gate
+        self.checkpointer = Checkpointer(self)
+        self.bufferpool.on_full = self.checkpointer.request
+        self.checkpointer.start()
+
+    # reads db_meta.json and every table_meta.json, returns the lsn they were checkpointed at
+    def _load_meta(self):
+        path = self.path
         meta_pth = os.path.join(path, 'db_meta.json')
         if not os.path.exists(meta_pth):
-            return None
+            return 0
         f = open(meta_pth, 'r')
         meta = json.load(f)
         f.close()
         for tn, info in meta['tables'].items():
             tbl = Table(info['name'], info['num_columns'], info['key'], bufferpool=self.bufferpool)
-            tmeta_pth = os.path.join(path, tn, 'table_meta.json')
-            if os.path.exists(tmeta_pth):
-                fp2 = open(tmeta_pth, 'r')
-                tmeta = json.load(fp2)
-                fp2.close()
-                tbl.next_rid = tmeta['next_rid']
-                for rid_str, locn in tmeta['page_directory'].items():
-                    tbl.page_directory[int(rid_str)] = tuple(locn)
-                tbl.page_ranges = []
-                for i, pm in enumerate(tmeta['page_ranges']):
-                    prange = PageRange(tbl.total_cols, table_name=tn, range_idx=i, bufferpool=self.bufferpool)
-                    prange.num_base_records = pm['num_base_records']
-                    prange.num_tail_records = pm['num_tail_records']
-                    if 'tps' in pm:
-                        prange.tps = {int(k): v for k, v in pm['tps'].items()}
-                    tbl.page_ranges.append(prange)
+            tbl.lock_manager = self.lock_manager
+            self._load_table_meta(tbl, os.path.join(path, tn))
             self.tables[tn] = tbl
             self._rebuild_indexes(tbl)
+        return meta.get('checkpoint_lsn', 0)
+
+    """
+    # Loads table_meta.json, then replays the delta lines later checkpoints appended to
+    # table_meta.delta, lines from before the last full rewrite carry an older generation
+    # and get skipped, as does a torn last line
+    :param tbl: Table        # the freshly made table
+    :param tdir: str         # its directory
+    """
+    def _load_table_meta(self, tbl, tdir):
+        tmeta_pth = os.path.join(tdir, 'table_meta.json')
+        if not os.path.exists(tmeta_pth):
+            return
+        fp2 = open(tmeta_pth, 'r')
+        tmeta = json.load(fp2)
+        fp2.close()
+        gen = tmeta.get('generation', 0)
+        tbl.next_rid = tmeta['next_rid']
+        pdir = tbl.page_directory
+        for rid_str, locn in tmeta['page_directory'].items():
+            pdir[int(rid_str)] = tuple(locn)
+        ranges = {i: pm for i, pm in enumerate(tmeta['page_ranges'])}
+        entries = 0
+        delta_pth = os.path.join(tdir, 'table_meta.delta')
+        if os.path.exists(delta_pth):
+            f = open(delta_pth, 'r')
+            for line in f:
+                try:
+                    delta = json.loads(line)
+                except ValueError:
+                    break
+                if delta['generation'] != gen:
+                    continue
+                tbl.next_rid = delta['next_rid']
+                for rid, locn in delta['page_directory']:
+                    if locn is None:
+                        pdir.pop(rid, None)
+                    else:
+                        pdir[rid] = tuple(locn)
+                for i, pm in delta['page_ranges'].items():
+                    ranges[int(i)] = pm
+                entries = entries + len(delta['page_directory'])
+            f.close()
+        tbl.page_ranges = []
+        for i in range(len(ranges)):
+            pm = ranges[i]
+            prange = PageRange(tbl.total_cols, table_name=tbl.name, range_idx=i, bufferpool=self.bufferpool)
+            prange.num_base_records = pm['num_base_records']
+            prange.num_tail_records = pm['num_tail_records']
+            if 'tps' in pm:
+                prange.tps = {int(k): v for k, v in pm['tps'].items()}
+            if 'deleted' in pm:
+                prange.deleted = {int(k): v for k, v in pm['deleted'].items()}
+            tbl.page_ranges.append(prange)
+        pdir.take_changes()
+        self._persisted[tbl.name] = {'table': tbl, 'ranges': self._range_meta(tbl), 'entries': entries, 'generation': gen}
+
+    # page range metadata as a checkpoint copies it, one tuple per range
+    def _range_meta(self, tbl):
+        return [(pr.num_base_records, pr.num_tail_records, dict(pr.tps), dict(pr.deleted)) for pr in tbl.page_ranges]
+
+    """
+    # Redo recovery: reapplies every logged op newer than the checkpoint, in log order
+    # runs before the tables get their wal back so nothing is logged twice
+    :param records: list     # (lsn, ops) from WriteAheadLog.read
+    :param lsn: int          # checkpoint lsn, older records are already in the pages
+    """
+    def _replay(self, records, lsn):
+        queries = {}
+        for rec_lsn, ops in records:
+            if rec_lsn <= lsn:
+                continue
+            for op in ops:
+                tn, kind, args = op[0], op[1], op[2:]
+                if kind == 'create_table':
+                    self.create_table(tn, *args)
+                    continue
+                if kind == 'drop_table':
+                    self.drop_table(tn)
+                    queries.pop(tn, None)
+                    continue
+                if tn not in self.tables:
+                    continue
+                q = queries.get(tn)
+                if q is None:
+                    q = queries[tn] = Query(self.tables[tn])
+                if kind == 'insert':
+                    q.insert(*args[0])
+                elif kind == 'update':
+                    q.update(args[0], *args[1])
+                elif kind == 'delete':
+                    q.delete(args[0])
 
     # saves everything to disk, flushes dirty pages and writes out all the metadata json files
     def close(self):
         if self.path is None:
             return
+        if self.checkpointer is not None:
+            self.bufferpool.on_full = None
+            self.checkpointer.stop()
+            self.checkpointer = None
         for tbl in self.tables.values():
             if tbl.merge_thread is not None and tbl.merge_thread.is_alive():
                 tbl.merge_thread.join()
-        self.bufferpool.flush_all()
-        meta = {'tables': {}}
-        for tn, tbl in self.tables.items():
-            meta['tables'][tn] = {'name': tbl.name, 'num_columns': tbl.num_columns, 'key': tbl.key}
-        meta_pth = os.path.join(self.path, 'db_meta.json')
-        f = open(meta_pth, 'w')
-        json.dump(meta, f)
+        self.checkpoint()
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+            for tbl in self.tables.values():
+                tbl.wal = None
+                tbl.gate = None
+        self.bufferpool.no_steal = False
+
+    """
+    # Online checkpoint: dirty pages plus the metadata that changed, tagged with the last lsn
+    # writers are held off only while the snapshot is copied in memory, the disk writes
+    # happen with queries running, pages written to meanwhile just stay dirty for next time
+    # a table's metadata goes out as a delta (the page directory entries and page ranges that
+    # changed) appended to table_meta.delta, once the deltas add up to a good part of the
+    # directory the table gets a full table_meta.json again under a new generation
+    # everything goes into one staging file first (fsynced, then renamed into place) and only
+    # then over the real files, so a crash midway leaves either the old checkpoint or a
+    # complete staged one that open finishes, never a mix, afterwards the log segments it
+    # covers are deleted so recovery never replays more than one checkpoint's worth
+    :param background: bool     # run it on its own thread and return that thread
+    """
+    def checkpoint(self, background=False):
+        if self.path is None:
+            return False
+        if background:
+            th = threading.Thread(target=self.checkpoint, daemon=True)
+            th.start()
+            return th
+        with self._checkpoint_lock:
+            lsn, seq, meta, tables, pages = self._snapshot()
+            ok = False
+            try:
+                if self.wal is not None:
+                    # the log has to be on disk before pages that depend on it
+                    self.wal.wait(lsn)
+                tmetas = {}
+                for tn, snap in tables.items():
+                    tmeta = self._table_meta(snap)
+                    if tmeta is not None:
+                        tmetas[tn] = tmeta
+                stage = os.path.join(self.path, CHECKPOINT_FILE)
+                f = open(stage + '.tmp', 'wb')
+                pickle.dump({'meta': meta, 'tables': tmetas, 'pages': pages}, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                os.replace(stage + '.tmp', stage)
+                self._finish_checkpoint()
+                ok = True
+            finally:
+                self.bufferpool.end_flush([pid for pid, _, _ in pages], ok)
+                if not ok:
+                    # the next checkpoint has to save these directory entries after all
+                    for snap in tables.values():
+                        snap['table'].page_directory.changed.update(snap['taken'])
+            for tn, snap in tables.items():
+                old = self._persisted.get(tn)
+                entries = 0 if snap['full'] else old['entries'] + len(snap['page_directory'])
+                self._persisted[tn] = {'table': snap['table'], 'ranges': snap['page_ranges'],
+                                       'entries': entries, 'generation': snap['generation']}
+            if self.wal is not None:
+                self.wal.drop_before(seq)
+            self.checkpoint_lsn = lsn
+        return True
+
+    # the consistent cut a checkpoint writes: with the gate shut every write made so far has
+    # its log record queued and no transaction is halfway, table metadata is copied before
+    # the pages so a merge running alongside can only make the pages newer than the TPS says
+    # only the directory entries that changed get copied unless the table is due a full one
+    def _snapshot(self):
+        self.gate.close()
+        try:
+            lsn = self.wal.next_lsn - 1 if self.wal is not None else 0
+            seq = self.wal.rotate() if self.wal is not None else None
+            meta = {'tables': {}, 'checkpoint_lsn': lsn}
+            tables = {}
+            for tn, tbl in list(self.tables.items()):
+                meta['tables'][tn] = {'name': tbl.name, 'num_columns': tbl.num_columns, 'key': tbl.key}
+                pdir = tbl.page_directory
+                taken = pdir.take_changes()
+                old = self._persisted.get(tn)
+                full = (old is None or old['table'] is not tbl
+                        or old['entries'] + len(taken) > CHECKPOINT_COMPACT_RATIO * len(pdir))
+                tables[tn] = {
+                    'table': tbl,
+                    'full': full,
+                    'generation': (old['generation'] + 1 if old is not None else 1) if full else old['generation'],
+                    'old_ranges': None if full else old['ranges'],
+                    'taken': taken,
+                    'next_rid': tbl.next_rid,
+                    'page_directory': dict(pdir) if full else {rid: pdir.get(rid) for rid in taken},
+                    'page_ranges': self._range_meta(tbl),
+                }
+            pages = self.bufferpool.dirty_snapshot()
+        finally:
+            self.gate.open()
+        return lsn, seq, meta, tables, pages
+
+    # one range's metadata as it goes into the json files
+    def _range_json(self, rng):
+        nbase, ntail, tps, deleted = rng
+        return {
+            'num_base_records': nbase,
+            'num_tail_records': ntail,
+            'tps': {str(k): v for k, v in tps.items()},
+            'deleted': {str(k): v for k, v in deleted.items()}
+        }
+
+    # what a table's _snapshot turns into in the staging file: {'full': table_meta.json}
+    # or {'delta': one table_meta.delta line}, None when nothing changed
+    def _table_meta(self, snap):
+        if snap['full']:
+            pdir = {}
+            for k, v in snap['page_directory'].items():
+                pdir[str(k)] = list(v)
+            prlist = [self._range_json(rng) for rng in snap['page_ranges']]
+            return {'full': {'next_rid': snap['next_rid'], 'generation': snap['generation'],
+                             'page_directory': pdir, 'page_ranges': prlist}}
+        old = snap['old_ranges']
+        ranges = {}
+        for i, rng in enumerate(snap['page_ranges']):
+            if i >= len(old) or old[i] != rng:
+                ranges[str(i)] = self._range_json(rng)
+        if not snap['page_directory'] and not ranges:
+            return None
+        pdir = [[rid, list(locn) if locn is not None else None] for rid, locn in snap['page_directory'].items()]
+        return {'delta': {'generation': snap['generation'], 'next_rid': snap['next_rid'],
+                          'page_directory': pdir, 'page_ranges': ranges}}
+
+    # copies a staged checkpoint over the real page and metadata files, then drops it
+    def _finish_checkpoint(self):
+        stage = os.path.join(self.path, CHECKPOINT_FILE)
+        if not os.path.exists(stage):
+            return
+        f = open(stage, 'rb')
+        ckpt = pickle.load(f)
         f.close()
-        for tn, tbl in self.tables.items():
+        for pid, nrec, data in ckpt['pages']:
+            self.bufferpool.write_raw(pid, nrec, data)
+        for tn, tmeta in ckpt['tables'].items():
             tdir = os.path.join(self.path, tn)
             os.makedirs(tdir, exist_ok=True)
-            pdir = {}
-            for k, v in tbl.page_directory.items():
-                pdir[str(k)] = list(v)
-            prlist = []
-            for prange in tbl.page_ranges:
-                prlist.append({
-                    'num_base_records': prange.num_base_records,
-                    'num_tail_records': prange.num_tail_records,
-                    'tps': {str(k): v for k, v in prange.tps.items()}
-                })
-            tmeta = {'next_rid': tbl.next_rid, 'page_directory': pdir, 'page_ranges': prlist}
-            tmeta_pth = os.path.join(tdir, 'table_meta.json')
-            f = open(tmeta_pth, 'w')
-            json.dump(tmeta, f)
-            f.close()
+            delta_pth = os.path.join(tdir, 'table_meta.delta')
+            if 'delta' in tmeta:
+                _append_json_line(delta_pth, tmeta['delta'])
+                continue
+            _write_json(os.path.join(tdir, 'table_meta.json'), tmeta.get('full', tmeta))
+            # older deltas carry the old generation so a crash before this is harmless
+            if os.path.exists(delta_pth):
+                os.remove(delta_pth)
+        _write_json(os.path.join(self.path, 'db_meta.json'), ckpt['meta'])
+        os.remove(stage)
 
     # rebuild inddex from page directory (only key colum needed)
     def _rebuild_indexes(self, tbl):
@@ -98,17 +369,75 @@ class Database:
         if name in self.tables:
             return self.tables[name]
         tbl = Table(name, num_columns, key_index, bufferpool=self.bufferpool)
-        self.tables[name] = tbl
+        tbl.lock_manager = self.lock_manager
+        if self.wal is None:
+            self.tables[name] = tbl
+            return tbl
+        with self.gate:
+            self.wal.append([[name, 'create_table', num_columns, key_index]])
+            tbl.wal = self.wal
+            tbl.gate = self.gate
+            self.tables[name] = tbl
         return tbl
 
 
     # removes a table
     def drop_table(self, name):
-        if name in self.tables:
+        if name not in self.tables:
+            return False
+        if self.wal is None:
             del self.tables[name]
             return True
-        return False
+        with self.gate:
+            del self.tables[name]
+            self.wal.append([[name, 'drop_table']])
+        return True
 
     # returns the desired table
     def get_table(self, name):
         return self.tables.get(name, None)
+
+    # hash joins two tables by name, see Query.join
+    def join(self, left_name, right_name, left_column, right_column, left_projection, right_projection):
+        left = self.tables.get(left_name)
+        right = self.tables.get(right_name)
+        if left is None or right is None:
+            return False
+        return Query(left).join(right, left_column, right_column, left_projection, right_projection)
+
+    """
+    # Spreads a batch of transactions round robin over worker threads, runs them and waits
+    # returns the combined worker stats, per worker numbers are under 'workers'
+    :param transactions: list   # the transactions to run
+    :param num_workers: int     # how many worker threads
+    :param mode: str            # optional concurrency control mode forced on every transaction
+    """
+    def run_transactions(self, transactions, num_workers=NUM_WORKERS, mode=None):
+        workers = [TransactionWorker(mode=mode) for _ in range(max(1, num_workers))]
+        for i, txn in enumerate(transactions):
+            workers[i % len(workers)].add_transaction(txn)
+        for w in workers:
+            w.run()
+        for w in workers:
+            w.join()
+        reports = [w.report() for w in workers]
+        lat = [x for w in workers for x in w.latencies]
+        return {
+            'commits': sum(r['commits'] for r in reports),
+            'aborts': sum(r['aborts'] for r in reports),
+            'retries': sum(r['retries'] for r in reports),
+            'avg_latency': sum(lat) / len(lat) if lat else 0.0,
+            'workers': reports,
+        }
+
+    """
+    # Runs a batch deterministically: transactions are grouped by the keys they declare
+    # through add_query, groups that share no written key run side by side and each group
+    # runs in submission order, no locks and no retries, see lstore/scheduler.py
+    # since nothing is locked it shouldnt overlap with run_transactions on the same tables
+    # returns commits, aborts (only queries that failed on their own), groups, largest_group
+    :param transactions: list   # the batch, in submission order
+    :param num_workers: int     # how many worker threads
+    """
+    def run_batch(self, transactions, num_workers=NUM_WORKERS):
+        return BatchScheduler(transactions).run(num_workers)
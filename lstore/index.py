@@ -1,3 +1,4 @@
+import threading
 from bisect import bisect_left, bisect_right, insort
 
 class Index:
@@ -11,6 +12,13 @@ class Index:
         self.sorted_keys = [None] * table.num_columns
         self.indices[table.key] = {}
         self.sorted_keys[table.key] = []
+        # col -> (map, sorted keys, touched rids) for indexes being built in the background
+        self.building = {}
+        self._build_lock = threading.Lock()
+        # serializes writers so concurrent transactions dont race on the key lists
+        self._write_lock = threading.RLock()
+        # bumped whenever an index appears or goes away so prepared plans know to re-plan
+        self.version = 0
 
     """
     # Locates a specific value
@@ -31,16 +39,96 @@ class Index:
     :param col: int           # the index of the column within indices
     """
     def locate_range(self, begin, end, col):
+        if self.indices[col] is None:
+            return []
+        return list(self.iter_range(begin, end, col))
+
+    """
+    # Streams the RIDs for a value one at a time instead of copying the whole list
+    :param col: int      # the number column in the database
+    :param val: int      # the value we are searching for
+    """
+    def iter_locate(self, col, val):
         mp = self.indices[col]
         if mp is None:
-            return []
+            return
+        lst = mp.get(val)
+        if lst is None:
+            return
+        # buckets are tiny so snapshot it, callers may delete while we yield
+        for rid in tuple(lst):
+            yield rid
+
+    """
+    # Streams the RIDs of a range in key order, stops early once limit rids came out
+    # we re-bisect after every key so deletes/inserts while iterating dont break the cursor
+    :param begin: int         # beginning of the range
+    :param end: int           # end of the range
+    :param col: int           # the index of the column within indices
+    :param limit: int         # max number of rids to yield, None means no limit
+    """
+    def iter_range(self, begin, end, col, limit=None):
+        mp = self.indices[col]
+        if mp is None:
+            return
+        if limit is not None and limit <= 0:
+            return
         klist = self.sorted_keys[col]
-        low = bisect_left(klist, begin)
-        high = bisect_right(klist, end)
-        res = []
-        for i in range(low, high):
-            res.extend(mp[klist[i]])
-        return res
+        ix = bisect_left(klist, begin)
+        cnt = 0
+        while ix < len(klist):
+            k = klist[ix]
+            if k > end:
+                return
+            for rid in tuple(mp.get(k, ())):
+                yield rid
+                cnt = cnt + 1
+                if limit is not None and cnt >= limit:
+                    return
+            ix = bisect_right(klist, k)
+
+    """
+    # Streams (key, rid) over a whole column in key order, ascending or descending
+    # same re-bisect trick as iter_range so it survives writes while its being consumed
+    :param col: int           # the index of the column within indices
+    :param descending: bool   # largest key first
+    """
+    def iter_ordered(self, col, descending=False):
+        mp = self.indices[col]
+        if mp is None:
+            return
+        klist = self.sorted_keys[col]
+        if not descending:
+            ix = 0
+            while ix < len(klist):
+                k = klist[ix]
+                for rid in tuple(mp.get(k, ())):
+                    yield k, rid
+                ix = bisect_right(klist, k)
+            return
+        ix = len(klist) - 1
+        while ix >= 0:
+            k = klist[ix]
+            for rid in tuple(mp.get(k, ())):
+                yield k, rid
+            ix = bisect_left(klist, k) - 1
+
+    """
+    # Estimates how many rids fall in [begin, end], None if the column has no index
+    # counts the distinct keys with two bisects and assumes rids are spread evenly over keys
+    :param begin: int         # beginning of the range
+    :param end: int           # end of the range
+    :param col: int           # the index of the column within indices
+    :param total: int         # how many records the table has
+    """
+    def estimate_range(self, begin, end, col, total):
+        klist = self.sorted_keys[col]
+        if self.indices[col] is None or klist is None:
+            return None
+        if not klist or begin > end:
+            return 0
+        nkeys = bisect_right(klist, end) - bisect_left(klist, begin)
+        return nkeys * total / len(klist)
 
     """
     # Inserts a record into the index
@@ -49,12 +137,17 @@ class Index:
     :param col: int        # the number column in the database
     """
     def insert_entry(self, col, val, rid):
-        if self.indices[col] is None:
-            return
-        mp = self.indices[col]
+        with self._write_lock:
+            mp = self.indices[col]
+            if mp is not None:
+                self._insert_into(mp, self.sorted_keys[col], val, rid)
+            if self.building and col in self.building:
+                self._building_write(col, val, rid, self._insert_into)
+
+    def _insert_into(self, mp, klist, val, rid):
         if val not in mp:
             mp[val] = []
-            insort(self.sorted_keys[col], val)
+            insort(klist, val)
         mp[val].append(rid)
 
 
@@ -66,8 +159,9 @@ class Index:
     :param col: int         # the number column in the database
     """
     def update_entry(self, col, old_v, new_v, rid):
-        self.delete_entry(col, old_v, rid)
-        self.insert_entry(col, new_v, rid)
+        with self._write_lock:
+            self.delete_entry(col, old_v, rid)
+            self.insert_entry(col, new_v, rid)
 
 
     """
@@ -77,9 +171,14 @@ class Index:
     :param col: int        # the number column in the database
     """
     def delete_entry(self, col, val, rid):
-        mp = self.indices[col]
-        if mp is None:
-            return
+        with self._write_lock:
+            mp = self.indices[col]
+            if mp is not None:
+                self._delete_from(mp, self.sorted_keys[col], val, rid)
+            if self.building and col in self.building:
+                self._building_write(col, val, rid, self._delete_from)
+
+    def _delete_from(self, mp, klist, val, rid):
         if val not in mp:
             return
         try:
@@ -88,29 +187,94 @@ class Index:
             pass
         if len(mp[val]) == 0:
             del mp[val]
-            klist = self.sorted_keys[col]
             ix = bisect_left(klist, val)
             if ix < len(klist) and klist[ix] == val:
                 klist.pop(ix)
 
+    """
+    # Deletes a batch of (value, rid) pairs from one column's index
+    # emptied keys get cut out of the sorted key list in one pass instead of a pop each
+    :param col: int        # the number column in the database
+    :param pairs: list     # (value, rid) pairs to remove
+    """
+    def delete_entries(self, col, pairs):
+        with self._write_lock:
+            mp = self.indices[col]
+            if mp is not None:
+                emptied = set()
+                for val, rid in pairs:
+                    lst = mp.get(val)
+                    if lst is None:
+                        continue
+                    try:
+                        lst.remove(rid)
+                    except ValueError:
+                        pass
+                    if not lst:
+                        del mp[val]
+                        emptied.add(val)
+                if emptied:
+                    klist = self.sorted_keys[col]
+                    klist[:] = [k for k in klist if k not in emptied]
+            if self.building and col in self.building:
+                for val, rid in pairs:
+                    self._building_write(col, val, rid, self._delete_from)
+
+    """
+    # Applies a write to an index that is still being built and marks the rid as touched
+    # so the builder wont overwrite it with the value it read before the write
+    :param col: int        # the number column in the database
+    :param val: int        # the value being inserted/deleted
+    :param rid: int        # the id of the record
+    :param fn: function    # _insert_into or _delete_from
+    """
+    def _building_write(self, col, val, rid, fn):
+        with self._build_lock:
+            bld = self.building.get(col)
+            if bld is None:
+                return
+            mp, klist, touched = bld
+            touched.add(rid)
+            fn(mp, klist, val, rid)
+
+    """
+    # True if writes to this column have to be reflected in the index (built or being built)
+    :param col: int        # the number column in the database
+    """
+    def maintained(self, col):
+        return self.indices[col] is not None or col in self.building
+
     """
     # Creates a brand new index
+    # with background=True the index is built on a thread and only becomes visible to
+    # lookups once its done, writes that happen meanwhile still go into it
     :param col_num: int      # the column number of the index  
+    :param background: bool  # build on a thread and return it instead of blocking
     """
-    def create_index(self, col_num):
+    def create_index(self, col_num, background=False):
         if self.indices[col_num] is not None:
-            return
-        self.indices[col_num] = {}
-        self.sorted_keys[col_num] = []
-        self._populate_index(col_num)
+            return None
+        with self._build_lock:
+            if col_num in self.building:
+                return None
+            self.building[col_num] = ({}, [], set())
+        if not background:
+            self._populate_index(col_num)
+            return None
+        th = threading.Thread(target=self._populate_index, args=(col_num,), daemon=True)
+        th.start()
+        return th
 
     """
     # Removes the index of a certain column
     :param col_num: int      # the column number of the index  
     """
     def drop_index(self, col_num):
+        with self._build_lock:
+            self.building.pop(col_num, None)
         self.indices[col_num] = None
         self.sorted_keys[col_num] = None
+        self.version = self.version + 1
 
 
     """
@@ -120,9 +284,31 @@ class Index:
     def _populate_index(self, col_num):
         from lstore.query import Query
         q = Query(self.table)
-        for rid, locn in self.table.page_directory.items():
-            (_, tail_flag, _, _) = locn
-            if tail_flag:
+        bld = self.building.get(col_num)
+        if bld is None:
+            return
+        mp, klist, touched = bld
+        pdir = self.table.page_directory
+        proj = [0] * self.table.num_columns
+        proj[col_num] = 1
+        for rid in list(pdir):
+            locn = pdir.get(rid)
+            if locn is None or locn[1]:
+                continue
+            try:
+                vls = q._get_record_values(rid, 0, proj)
+            except KeyError:
                 continue
-            vls = q._get_record_values(rid)
-            self.insert_entry(col_num, vls[col_num], rid)
+            with self._build_lock:
+                if self.building.get(col_num) is not bld:
+                    return
+                if rid in touched or rid not in pdir:
+                    continue
+                self._insert_into(mp, klist, vls[col_num], rid)
+        with self._build_lock:
+            if self.building.get(col_num) is not bld:
+                return
+            del self.building[col_num]
+            self.sorted_keys[col_num] = klist
+            self.indices[col_num] = mp
+            self.version = self.version + 1
@@ -0,0 +1,111 @@
+import threading
+from lstore.config import LOCK_SHARDS, LOCK_POLICY
+
+# modes a holder of the key mode can live alongside
+COMPATIBLE = {
+    'IS': ('IS', 'IX', 'S', 'SIX'),
+    'IX': ('IS', 'IX'),
+    'S': ('IS', 'S'),
+    'SIX': ('IS',),
+    'X': (),
+}
+
+# modes the key mode already gives you, asking for one of these again is free
+COVERS = {
+    'IS': ('IS',),
+    'IX': ('IS', 'IX'),
+    'S': ('IS', 'S'),
+    'SIX': ('IS', 'IX', 'S', 'SIX'),
+    'X': ('IS', 'IX', 'S', 'SIX', 'X'),
+}
+
+# mode a transaction ends up holding after asking for req on top of held
+def _upgrade(held, req):
+    if req in COVERS[held]:
+        return held
+    if held in COVERS[req]:
+        return req
+    # S + IX (either order) is the only pair neither covers
+    return 'SIX'
+
+
+class _Shard:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.locks = {}     # resource -> {transaction: mode}
+        self.waiting = 0
+
+
+"""
+# hierarchical S/X lock table used by transactions for strict two phase locking
+# resources are tuples: ('table', name) gets the intention locks, ('rid', name, rid) record
+# locks and ('key', name, key) guards a primary key whether a record has it or not, so a
+# delete and an insert of the same key meet there
+# the table is split into shards by resource hash so unrelated lock traffic never meets
+# on the same mutex
+# deadlocks cant happen: with 'no_wait' a conflicting request fails right away and with
+# 'wait_die' an older transaction waits for a younger holder but a younger one dies
+"""
+class LockManager:
+    def __init__(self, shards=LOCK_SHARDS, policy=LOCK_POLICY):
+        if policy not in ('no_wait', 'wait_die'):
+            raise ValueError('unknown lock policy %r' % (policy,))
+        self.policy = policy
+        self.shards = [_Shard() for _ in range(shards)]
+        self.denied = 0
+
+    """
+    # Grabs (or upgrades to) mode on a resource for a transaction
+    # returns False when the transaction has to abort instead
+    :param txn: Transaction   # needs .ts (smaller is older) and .locks (resource -> mode)
+    :param res: tuple         # the resource
+    :param mode: str          # 'IS', 'IX', 'S', 'SIX' or 'X'
+    """
+    def acquire(self, txn, res, mode):
+        held = txn.locks.get(res)
+        if held is not None:
+            if mode in COVERS[held]:
+                return True
+            mode = _upgrade(held, mode)
+        sh = self.shards[hash(res) % len(self.shards)]
+        ok = COMPATIBLE[mode]
+        with sh.cond:
+            while True:
+                holders = sh.locks.get(res)
+                if holders is None:
+                    sh.locks[res] = {txn: mode}
+                    break
+                blockers = [t for t, m in holders.items() if t is not txn and m not in ok]
+                if not blockers:
+                    holders[txn] = mode
+                    break
+                if self.policy == 'no_wait' or any(t.ts < txn.ts for t in blockers):
+                    self.denied = self.denied + 1
+                    return False
+                sh.waiting = sh.waiting + 1
+                sh.cond.wait()
+                sh.waiting = sh.waiting - 1
+        txn.locks[res] = mode
+        return True
+
+    """
+    # Drops every lock a transaction holds here, called once at commit or abort
+    # the caller resets txn.locks afterwards (it may span several managers)
+    :param txn: Transaction   # the transaction
+    """
+    def release_all(self, txn):
+        n = len(self.shards)
+        for res in txn.locks:
+            sh = self.shards[hash(res) % n]
+            with sh.cond:
+                holders = sh.locks.get(res)
+                if holders is not None:
+                    holders.pop(txn, None)
+                    if not holders:
+                        del sh.locks[res]
+                if sh.waiting:
+                    sh.cond.notify_all()
+
+    # number of resources currently locked by anyone, handy for tests and leaks
+    def num_locked(self):
+        return sum(len(sh.locks) for sh in self.shards)
@@ -1,3 +1,4 @@
+import os
 from struct import pack, pack_into, unpack, unpack_from
 from lstore.config import PAGE_SIZE, RECORD_SIZE, RECORDS_PER_PAGE
 
@@ -28,11 +29,15 @@ class Page:
         # reads the 64 bit integer stored at the given record position and returns it
         return unpack_from('q', self.data, idx * RECORD_SIZE)[0]
 
-def write_page_to_disk(page, filepath):
+def write_page_to_disk(page, filepath, sync=False):
     # first writes the number of records then writes the raw page bytes
+    # sync forces it onto the disk before returning (checkpoints need that)
     fp = open(filepath, 'wb')
     fp.write(pack('q', page.num_records))
     fp.write(page.data)
+    if sync:
+        fp.flush()
+        os.fsync(fp.fileno())
     fp.close()
 
 def read_page_from_disk(filepath):
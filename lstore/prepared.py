@@ -0,0 +1,104 @@
+from lstore.table import Record
+from lstore.config import *
+
+"""
+# a select that has its access path worked out ahead of time
+# the plan (index or scan, which column pages to read) is built once and only redone
+# when an index on the table gets created or dropped
+"""
+class PreparedSelect:
+    def __init__(self, query, column, projected_columns_index, raw=False):
+        self.query = query
+        self.table = query.table
+        self.column = column
+        self.raw = raw
+        self.proj = list(projected_columns_index)
+        self.out_cols = [i for i in range(self.table.num_columns) if self.proj[i]]
+        self.version = None
+        self._plan()
+
+    """
+    # Works out the access path and the page columns to read
+    """
+    def _plan(self):
+        idx = self.table.index
+        self.version = idx.version
+        self.index_map = idx.indices[self.column]
+        # (user column, page column) pairs so the page ids are just tuple builds at run time
+        self.read_cols = [(i, NUM_META_COLS + i) for i in self.out_cols]
+
+    """
+    # Runs the select for one value, same results as Query.select (tuples when raw)
+    :param value: int        # the value we are searching for
+    """
+    def __call__(self, value):
+        try:
+            # noted before the plan is checked, the advisor may change the indexes right here
+            self.query._note_lookup(self.column, self.table.index.indices[self.column] is None)
+            if self.version != self.table.index.version:
+                self._plan()
+            if self.index_map is not None:
+                rids = tuple(self.index_map.get(value, ()))
+            else:
+                rids = self.table.scan_eq(self.column, value)
+            res = []
+            for rid in rids:
+                vls = self._read(rid)
+                if vls is None:
+                    continue
+                if self.raw:
+                    res.append(tuple([vls[i] for i in self.out_cols]))
+                else:
+                    res.append(Record(rid, value, vls))
+            return res
+        except:
+            return False
+
+    """
+    # Reads the latest version of the projected columns of one record
+    :param rid: int          # base rid
+    """
+    def _read(self, rid):
+        tbl = self.table
+        pdir = tbl.page_directory
+        locn = pdir.get(rid)
+        if locn is None:
+            return None
+        rng_ix, _, pgnum, sl = locn
+        prange = tbl.page_ranges[rng_ix]
+        read_value = tbl.bufferpool.read_value
+        ind = read_value((tbl.name, rng_ix, False, pgnum, INDIRECTION_COLUMN), sl)
+        tail = False
+        if ind != NULL_RID and ind > prange.tps.get(pgnum, 0):
+            tl = pdir.get(ind)
+            if tl is not None:
+                rng_ix, _, pgnum, sl = tl
+                tail = True
+        vls = [None] * tbl.num_columns
+        for i, pc in self.read_cols:
+            vls[i] = read_value((tbl.name, rng_ix, tail, pgnum, pc), sl)
+        return vls
+
+
+"""
+# an update by primary key with the key index resolved ahead of time
+"""
+class PreparedUpdate:
+    def __init__(self, query):
+        self.query = query
+        self.table = query.table
+        self.key_map = self.table.index.indices[self.table.key]
+
+    """
+    # Same as Query.update
+    :param primary_key: int  # the main unique identifier for a record
+    :param *columns: tuple   # new values, None means leave it alone
+    """
+    def __call__(self, primary_key, *columns):
+        try:
+            rid_list = self.key_map.get(primary_key)
+            if not rid_list:
+                return False
+            return self.query._update_rid(rid_list[0], primary_key, columns)
+        except:
+            return False
@@ -1,6 +1,12 @@
 from lstore.table import Record
+from lstore.prepared import PreparedSelect, PreparedUpdate
 from lstore.config import *
-from time import time
+from lstore import clock, undo
+from itertools import islice
+from contextlib import nullcontext
+from heapq import nlargest, nsmallest
+
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
 
 class Query:
     """
@@ -18,17 +24,22 @@ class Query:
     """
     # find all base record RIDs where colum equals value, use inddex or full scan
     def _locate(self, column, value):
-        if self.table.index.indices[column] is not None:
+        if self._indexed(column):
             return self.table.index.locate(column, value)
-        rid_list = []
-        for rid, locn in self.table.page_directory.items():
-            _, tail_flag, _, _ = locn
-            if tail_flag:
-                continue
-            vls = self._get_record_values(rid)
-            if vls[column] == value:
-                rid_list.append(rid)
-        return rid_list
+        return list(self.table.scan_eq(column, value))
+
+    """
+    # Same as _locate but hands back rids lazily, stops after limit of them
+    :param column: int       # the number column in the database
+    :param value: int        # the value we are looking for
+    :param limit: int        # max number of rids, None means all of them
+    """
+    def _iter_locate(self, column, value, limit=None):
+        if self._indexed(column):
+            it = self.table.index.iter_locate(column, value)
+        else:
+            it = self.table.scan_eq(column, value)
+        return self._limit_iter(it, limit)
 
     """
     # Same idea as _locate but for a range of values instead of an exact match
@@ -38,17 +49,117 @@ class Query:
     """
     # same but for a range of values
     def _locate_range(self, begin, end, column):
-        if self.table.index.indices[column] is not None:
-            return self.table.index.locate_range(begin, end, column)
-        rid_list = []
-        for rid, locn in self.table.page_directory.items():
-            _, tail_flag, _, _ = locn
-            if tail_flag:
-                continue
-            vls = self._get_record_values(rid)
-            if begin <= vls[column] <= end:
-                rid_list.append(rid)
-        return rid_list
+        return list(self._iter_locate_range(begin, end, column))
+
+    """
+    # Streams rids for a range, in key order when the column has an index
+    :param begin: int        # lower bound of the range
+    :param end: int          # upper bound of the range
+    :param column: int       # the number column in the database
+    :param limit: int        # max number of rids, None means all of them
+    """
+    def _iter_locate_range(self, begin, end, column, limit=None):
+        if self._indexed(column):
+            return self.table.index.iter_range(begin, end, column, limit)
+        it = self.table.scan_rids(column, lambda v: begin <= v <= end)
+        return self._limit_iter(it, limit)
+
+    """
+    # Tells the table's index advisor a column was searched and what a scan of it costs
+    :param column: int       # the number column in the database
+    :param scanned: bool     # True if we had to fall back to a full scan
+    """
+    def _note_lookup(self, column, scanned):
+        self.table.advisor.record(column, self._num_base_records(), scanned)
+
+    """
+    # Notes a lookup on a column, then says whether it has an index to use
+    # in that order because the advisor can tune right inside _note_lookup and add or drop
+    # this very index, checking first could leave us probing an index thats gone
+    :param column: int       # the number column in the database
+    """
+    def _indexed(self, column):
+        self._note_lookup(column, self.table.index.indices[column] is None)
+        return self.table.index.indices[column] is not None
+
+    """
+    # Number of base records in the table (deleted ones included, its for cost estimates)
+    """
+    def _num_base_records(self):
+        nrec = 0
+        for prange in self.table.page_ranges:
+            nrec = nrec + prange.num_base_records
+        return nrec
+
+    """
+    # Picks index probe or sequential scan for a range query on a column
+    # returns a plan dict, same thing explain() hands back
+    :param begin: int        # lower bound of the range
+    :param end: int          # upper bound of the range
+    :param column: int       # the number column in the database
+    :param limit: int        # max rows wanted, set for paged reads which always take the index
+    """
+    def _plan_range(self, begin, end, column, limit=None):
+        total = self._num_base_records()
+        est = self.table.index.estimate_range(begin, end, column, total)
+        plan = {'column': column, 'begin': begin, 'end': end, 'total_rows': total}
+        if est is None:
+            plan.update(path='scan', est_rows=None, selectivity=None, reason='no index')
+            return plan
+        if limit is not None:
+            est = min(est, limit)
+        sel = est / total if total else 0.0
+        plan.update(est_rows=int(est), selectivity=sel)
+        if limit is not None:
+            # pages of one query must come in one order, the index gives key order whatever
+            # the page size while a scan would hand back storage order for the bigger pages
+            plan.update(path='index', reason='paged, index keeps key order')
+        elif sel > SCAN_SELECTIVITY_THRESHOLD:
+            plan.update(path='scan', reason='selectivity above %.2f' % SCAN_SELECTIVITY_THRESHOLD)
+        else:
+            plan.update(path='index', reason='selectivity at most %.2f' % SCAN_SELECTIVITY_THRESHOLD)
+        return plan
+
+    """
+    # Shows which access path a query would use without running it
+    # supported: ('select', value, column), ('select_range', begin, end, column[, limit]),
+    # ('sum', begin, end, aggregate_column)
+    :param op: str           # the query name
+    :param *args: tuple      # the arguments as you would pass them to that query
+    """
+    def explain(self, op, *args):
+        if op == 'select':
+            value, column = args[0], args[1]
+            mp = self.table.index.indices[column]
+            total = self._num_base_records()
+            if mp is None:
+                return {'op': op, 'column': column, 'path': 'scan', 'est_rows': None, 'total_rows': total, 'reason': 'no index'}
+            return {'op': op, 'column': column, 'path': 'index', 'est_rows': len(mp.get(value, ())), 'total_rows': total, 'reason': 'equality on indexed column'}
+        if op == 'select_range':
+            limit = args[3] if len(args) > 3 else None
+            plan = self._plan_range(args[0], args[1], args[2], limit)
+        elif op == 'sum':
+            summ = self.table.summaries.get(args[2])
+            if summ is not None:
+                first, last = summ.full_blocks(args[0], args[1])
+                if first <= last:
+                    return {'op': op, 'column': self.table.key, 'path': 'summary', 'full_blocks': last - first + 1,
+                            'total_rows': self._num_base_records(), 'reason': 'column summary covers whole blocks'}
+            plan = self._plan_range(args[0], args[1], self.table.key)
+        else:
+            return None
+        plan['op'] = op
+        return plan
+
+    """
+    # Cuts an iterator off after limit items, None just passes it through
+    :param it: iterator      # the rids we are streaming
+    :param limit: int        # max number of items
+    """
+    def _limit_iter(self, it, limit):
+        if limit is None:
+            return it
+        return islice(it, max(limit, 0))
 
 
     """
@@ -57,37 +168,70 @@ class Query:
     # it follows the chain of pointers to the tail record
     :param base_rid: int     # permanent ID of a record
     :param version: int      # controls how many tail records you follow
+    :param proj: list        # optional 0/1 per column, only those column pages get read
     """
     # get colum values for a record, follows tail chain if needed
-    def _get_record_values(self, base_rid, version=0):
+    def _get_record_values(self, base_rid, version=0, proj=None):
         locn = self.table.page_directory[base_rid]
         rng_ix, _, pgnum, sl = locn
         prange = self.table.page_ranges[rng_ix]
 
         ind = prange.get_base_val(pgnum, sl, INDIRECTION_COLUMN)
         if ind == NULL_RID:
-            return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns)
+            return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns, proj)
 
         if version == 0:
             tps_v = prange.tps.get(pgnum, 0)
             if ind <= tps_v:
-                return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns)
+                return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns, proj)
 
         curr = ind
-        nsteps = abs(version)
-        for _ in range(nsteps):
-            tl = self.table.page_directory[curr]
-            ti, _, tpg, tslot = tl
-            tp = self.table.page_ranges[ti]
-            prev_ind = tp.get_tail_val(tpg, tslot, INDIRECTION_COLUMN)
-            if prev_ind == NULL_RID:
-                return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns)
-            curr = prev_ind
-
-        tl = self.table.page_directory[curr]
+        if version != 0:
+            # older versions come straight out of the version index instead of hopping the chain
+            rid_list = self.table.version_chain(base_rid)[1]
+            ix = len(rid_list) - 1 - abs(version)
+            if ix < 0:
+                # past the oldest tail is the original row, in the base record until a merge
+                # overwrites it and in the copy merge leaves at the end of the chain after that
+                if not prange.get_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN) & ORIGINAL_SAVED:
+                    return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns, proj)
+                ix = 0
+            curr = rid_list[ix]
+
+        return self._read_version(prange, pgnum, sl, curr, proj)
+
+    """
+    # Reads the values of one version of a record, tail_rid NULL_RID means the base record
+    :param prange: PageRange # page range of the base record
+    :param pgnum: int        # base page
+    :param sl: int           # base slot
+    :param tail_rid: int     # the tail record to read or NULL_RID
+    :param proj: list        # optional 0/1 per column
+    """
+    def _read_version(self, prange, pgnum, sl, tail_rid, proj=None):
+        if tail_rid == NULL_RID:
+            return prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.table.num_columns, proj)
+        tl = self.table.page_directory[tail_rid]
         ti, _, tpg, tslot = tl
         tp = self.table.page_ranges[ti]
-        return tp.get_tail_vals(tpg, tslot, NUM_META_COLS, self.table.num_columns)
+        return tp.get_tail_vals(tpg, tslot, NUM_META_COLS, self.table.num_columns, proj)
+
+    """
+    # Returns the column values of a record as they were at a timestamp, None if the
+    # record didnt exist yet, uses the version index so its a bisect not a chain walk
+    :param base_rid: int     # permanent ID of a record
+    :param ts: int           # the timestamp to read as of
+    :param proj: list        # optional 0/1 per column
+    :param locn: tuple       # its page directory entry, needed once its been deleted
+    """
+    def _get_record_values_as_of(self, base_rid, ts, proj=None, locn=None):
+        if locn is None:
+            locn = self.table.page_directory[base_rid]
+        tail_rid = self.table.version_as_of(base_rid, ts, locn)
+        if tail_rid is None:
+            return None
+        rng_ix, _, pgnum, sl = locn
+        return self._read_version(self.table.page_ranges[rng_ix], pgnum, sl, tail_rid, proj)
 
 
     """
@@ -100,17 +244,174 @@ class Query:
             rid_list = self.table.index.locate(self.table.key, primary_key)
             if not rid_list:
                 return False
-            rid = rid_list[0]
-            vls = self._get_record_values(rid)
+            return self._delete_rid(rid_list[0])
+        except:
+            return False
+
+    # the checkpoint gate every write goes through once the database is open, a transaction
+    # is already inside it so its queries pass straight through
+    def _writing(self):
+        gate = self.table.gate
+        return gate if gate is not None else nullcontext()
+
+    """
+    # Does the actual delete once we know the base rid
+    :param rid: int          # base rid of the record
+    :param tombstone: bool   # leave a tombstone for as-of reads, not when rolling back an
+                             # insert since nobody was ever meant to see that record
+    """
+    def _delete_rid(self, rid, tombstone=True):
+        with self._writing(), self.table.latch_for(rid):
+            if rid not in self.table.page_directory:
+                return False
+            # only the indexed/summarized columns are needed to clean up after it
+            summs = list(self.table.summaries.items())
+            proj = [1 if self.table.index.maintained(i) else 0 for i in range(self.table.num_columns)]
+            for col, _ in summs:
+                proj[col] = 1
+            proj[self.table.key] = 1
+            vls = self._get_record_values(rid, 0, proj)
             for i in range(self.table.num_columns):
-                if self.table.index.indices[i] is not None:
+                if self.table.index.maintained(i):
                     self.table.index.delete_entry(i, vls[i], rid)
-            if rid in self.table.page_directory:
-                del self.table.page_directory[rid]
+            for col, summ in summs:
+                summ.add(vls[self.table.key], vls[col], -1)
+            if self.table.row_cache is not None:
+                self.table.row_cache.invalidate(vls[self.table.key])
+            if tombstone:
+                self.table.add_tombstone(vls[self.table.key], rid, self.table.page_directory[rid], clock.now())
+            locn = self.table.page_directory.pop(rid)
+            rng_ix, _, pgnum, sl = locn
+            self.table.page_ranges[rng_ix].mark_deleted(pgnum, sl)
+            self.table.versions.pop(rid, None)
+            log = undo.current()
+            if log is not None:
+                log.push(self._undo_delete, rid, locn)
+            if self.table.wal is not None:
+                self.table.wal.log(self.table.name, ['delete', vls[self.table.key]])
             return True
+
+    """
+    # Brings a deleted record back for a rollback: page directory entry, delete bit,
+    # index entries and summaries, its tombstone goes
+    :param rid: int          # base rid of the record
+    :param locn: tuple       # its page directory entry
+    """
+    def _undo_delete(self, rid, locn):
+        with self.table.latch_for(rid):
+            rng_ix, _, pgnum, sl = locn
+            prange = self.table.page_ranges[rng_ix]
+            # merges skip deleted slots, one that went by meanwhile (or is still running) can
+            # leave the TPS covering our newest tail without the base page having it, so we
+            # copy it in ourselves
+            ind = prange.get_base_val(pgnum, sl, INDIRECTION_COLUMN)
+            if ind != NULL_RID and ind in self.table.page_directory:
+                self.table.save_original(rid, rng_ix, pgnum, sl)
+                ti, _, tpg, tslot = self.table.page_directory[ind]
+                vls = self.table.page_ranges[ti].get_tail_vals(tpg, tslot, NUM_META_COLS, self.table.num_columns)
+                for i in range(self.table.num_columns):
+                    prange.set_base_val(pgnum, sl, NUM_META_COLS + i, vls[i])
+            prange.clear_deleted(pgnum, sl)
+            self.table.page_directory[rid] = locn
+            vls = self._get_record_values(rid)
+            self.table.drop_tombstone(vls[self.table.key], rid)
+            for i in range(self.table.num_columns):
+                if self.table.index.maintained(i):
+                    self.table.index.insert_entry(i, vls[i], rid)
+            for col, summ in list(self.table.summaries.items()):
+                summ.add(vls[self.table.key], vls[col])
+
+    """
+    # Deletes a bunch of primary keys, sorted by where they live so pages get hit in order
+    :param keys: list        # primary keys to delete
+    """
+    def delete_many(self, keys):
+        res = [False] * len(keys)
+        for i, rid in self._sorted_by_location(keys):
+            try:
+                res[i] = self._delete_rid(rid)
+            except:
+                res[i] = False
+        return res
+
+    """
+    # Deletes every record whose primary key is in [begin, end], returns how many went
+    :param begin: int        # lower bound of the key range
+    :param end: int          # upper bound of the key range
+    """
+    def delete_range(self, begin, end):
+        try:
+            return self._delete_batch(list(self.table.index.iter_range(begin, end, self.table.key)))
+        except:
+            return False
+
+    """
+    # Deletes every record whose column passes predicate, found with one columnar scan
+    # returns how many went
+    :param column: int       # the column the predicate looks at
+    :param predicate: function  # takes the column value, True means delete the record
+    """
+    def delete_where(self, column, predicate):
+        try:
+            return self._delete_batch(list(self.table.scan_rids(column, predicate)))
         except:
             return False
 
+    """
+    # Deletes a batch of base rids in page order, sets their delete bits and takes them
+    # out of each index with one batched call per column instead of one per record
+    :param rids: list        # base rids to delete
+    """
+    def _delete_batch(self, rids):
+        with self._writing():
+            pdir = self.table.page_directory
+            ncols = self.table.num_columns
+            kcol = self.table.key
+            idx = self.table.index
+            summs = list(self.table.summaries.items())
+            icols = [i for i in range(ncols) if idx.maintained(i)]
+            proj = [0] * ncols
+            for i in icols:
+                proj[i] = 1
+            for col, _ in summs:
+                proj[col] = 1
+            proj[kcol] = 1
+            located = []
+            for rid in rids:
+                locn = pdir.get(rid)
+                if locn is not None:
+                    located.append((locn[0], locn[2], locn[3], rid))
+            located.sort()
+            removed = {i: [] for i in icols}
+            gone = []
+            cnt = 0
+            for rng_ix, pgnum, sl, rid in located:
+                with self.table.latch_for(rid):
+                    if rid not in pdir:
+                        continue
+                    vls = self._get_record_values(rid, 0, proj)
+                    gone.append((rid, pdir[rid]))
+                    self.table.add_tombstone(vls[kcol], rid, pdir[rid], clock.now())
+                    if self.table.wal is not None:
+                        self.table.wal.log(self.table.name, ['delete', vls[kcol]])
+                    del pdir[rid]
+                    self.table.page_ranges[rng_ix].mark_deleted(pgnum, sl)
+                    self.table.versions.pop(rid, None)
+                    if self.table.row_cache is not None:
+                        self.table.row_cache.invalidate(vls[kcol])
+                for i in icols:
+                    removed[i].append((vls[i], rid))
+                for col, summ in summs:
+                    summ.add(vls[kcol], vls[col], -1)
+                cnt = cnt + 1
+            for i in icols:
+                idx.delete_entries(i, removed[i])
+            # pushed once the index entries are gone, _undo_delete puts them back
+            log = undo.current()
+            if log is not None:
+                for rid, locn in gone:
+                    log.push(self._undo_delete, rid, locn)
+            return cnt
 
     """
     # Inserts a brand new record to the table as a base record and includes where to store and what is stored
@@ -128,23 +429,33 @@ class Query:
             if self.table.index.locate(self.table.key, kv):
                 return False
 
-            rid = self.table.new_rid()
-            rng_ix, prange = self.table._current_range()
+            with self._writing():
+                rid = self.table.new_rid()
+                log = undo.current()
+                if log is not None and log.claim is not None and not log.claim(self.table, rid):
+                    return False
+                rng_ix, prange = self.table._current_range()
 
-            row = [0] * self.table.total_cols
-            row[INDIRECTION_COLUMN] = NULL_RID
-            row[RID_COLUMN] = rid
-            row[TIMESTAMP_COLUMN] = int(time())
-            row[SCHEMA_ENCODING_COLUMN] = 0
-            for i in range(self.table.num_columns):
-                row[NUM_META_COLS + i] = columns[i]
+                row = [0] * self.table.total_cols
+                row[INDIRECTION_COLUMN] = NULL_RID
+                row[RID_COLUMN] = rid
+                row[TIMESTAMP_COLUMN] = clock.now()
+                row[SCHEMA_ENCODING_COLUMN] = 0
+                for i in range(self.table.num_columns):
+                    row[NUM_META_COLS + i] = columns[i]
 
-            pgnum, sl = prange.add_base_record(row)
-            self.table.page_directory[rid] = (rng_ix, False, pgnum, sl)
+                pgnum, sl = prange.add_base_record(row)
+                self.table.page_directory[rid] = (rng_ix, False, pgnum, sl)
 
-            for i in range(self.table.num_columns):
-                if self.table.index.indices[i] is not None:
-                    self.table.index.insert_entry(i, columns[i], rid)
+                for i in range(self.table.num_columns):
+                    if self.table.index.maintained(i):
+                        self.table.index.insert_entry(i, columns[i], rid)
+                for col, summ in list(self.table.summaries.items()):
+                    summ.add(kv, columns[col])
+                if log is not None:
+                    log.push(self._delete_rid, rid, False)
+                if self.table.wal is not None:
+                    self.table.wal.log(self.table.name, ['insert', list(columns)])
 
             return True
         except:
@@ -159,30 +470,567 @@ class Query:
     :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
     """
     # searches for a value using search keys, and then selects it
-    def select(self, search_key, search_key_index, projected_columns_index):
+    def select(self, search_key, search_key_index, projected_columns_index, limit=None):
         try:
-            rid_list = self._locate(search_key_index, search_key)
-            if not rid_list:
+            return list(self.select_iter(search_key, search_key_index, projected_columns_index, limit=limit))
+        except:
+            return False
+
+    """
+    # Cursor version of select, yields one row at a time so big results run in constant memory
+    # raw=True yields plain tuples of just the projected columns instead of Records
+    :param search_key: int           # value we are searching for
+    :param search_key_index: int     # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # yield tuples instead of Records
+    :param limit: int                # max number of rows, None means all
+    """
+    def select_iter(self, search_key, search_key_index, projected_columns_index, raw=False, limit=None):
+        if search_key_index == self.table.key and self.table.row_cache is not None and limit != 0:
+            return self._cached_select(search_key, projected_columns_index, raw)
+        rids = self._iter_locate(search_key_index, search_key, limit)
+        return self._cursor(rids, projected_columns_index, raw, search_key)
+
+    """
+    # Primary key select through the row cache, a hit never touches the page directory
+    :param search_key: int           # primary key we are searching for
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # yield a tuple instead of a Record
+    """
+    def _cached_select(self, search_key, projected_columns_index, raw):
+        ent = self._cached_row(search_key)
+        if ent is None:
+            return
+        rid, vals = ent
+        if raw:
+            yield tuple([vals[i] for i in range(self.table.num_columns) if projected_columns_index[i]])
+            return
+        out = [vals[i] if projected_columns_index[i] else None for i in range(self.table.num_columns)]
+        yield Record(rid, search_key, out)
+
+    """
+    # Returns (rid, values) for a primary key from the row cache, filling it on a miss
+    # the fill happens under the record latch so it cant race a write and cache stale values
+    :param key: int          # primary key
+    """
+    def _cached_row(self, key):
+        cache = self.table.row_cache
+        ent = cache.get(key)
+        if ent is not None:
+            return ent
+        self._note_lookup(self.table.key, False)
+        rid_list = self.table.index.locate(self.table.key, key)
+        if not rid_list:
+            return None
+        rid = rid_list[0]
+        with self.table.latch_for(rid):
+            if rid not in self.table.page_directory:
+                return None
+            ent = (rid, tuple(self._get_record_values(rid)))
+            cache.put(key, ent)
+        return ent
+
+    """
+    # Selects every record whose column falls in [begin, end], one page of results at a time
+    # rids are streamed from the index so we never build the whole range up front
+    :param begin: int                # lower bound of the range
+    :param end: int                  # upper bound of the range
+    :param column: int               # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param limit: int                # max number of records to return, None means all
+    :param offset: int               # how many matching records to skip first (for paging)
+    """
+    def select_range(self, begin, end, column, projected_columns_index, limit=None, offset=0):
+        try:
+            return list(self.select_range_iter(begin, end, column, projected_columns_index, limit=limit, offset=offset))
+        except:
+            return False
+
+    """
+    # Cursor version of select_range
+    :param begin: int                # lower bound of the range
+    :param end: int                  # upper bound of the range
+    :param column: int               # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # yield tuples instead of Records
+    :param limit: int                # max number of rows, None means all
+    :param offset: int               # how many matching rows to skip first
+    """
+    def select_range_iter(self, begin, end, column, projected_columns_index, raw=False, limit=None, offset=0):
+        if limit is not None and limit <= 0:
+            return iter(())
+        stop = None if limit is None else offset + limit
+        plan = self._plan_range(begin, end, column, stop)
+        if plan['path'] == 'scan':
+            self._note_lookup(column, True)
+            rows = self._scan_rows(begin, end, column, projected_columns_index, raw)
+        else:
+            rids = self._iter_locate_range(begin, end, column)
+            rows = self._cursor(rids, projected_columns_index, raw)
+        return islice(rows, offset, stop)
+
+    """
+    # Sequential scan version of a range select, rows come straight out of the columnar
+    # scan in storage order so nothing gets rebuilt one rid at a time
+    :param begin: int                # lower bound of the range
+    :param end: int                  # upper bound of the range
+    :param column: int               # which column to filter on
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # yield tuples of the projected columns instead of Records
+    """
+    def _scan_rows(self, begin, end, column, projected_columns_index, raw):
+        kcol = self.table.key
+        ncols = self.table.num_columns
+        cols = [i for i in range(ncols) if projected_columns_index[i]]
+        read = list(cols)
+        for c in (column, kcol):
+            if c not in read:
+                read.append(c)
+        pos = {c: j for j, c in enumerate(read)}
+        for rids, vals in self.table.scan_columns(read):
+            fv = vals[pos[column]]
+            for i in range(len(rids)):
+                if not (begin <= fv[i] <= end):
+                    continue
+                if raw:
+                    yield tuple([vals[pos[c]][i] for c in cols])
+                    continue
+                out = [None] * ncols
+                for c in cols:
+                    out[c] = vals[pos[c]][i]
+                yield Record(rids[i], vals[pos[kcol]][i], out)
+
+    """
+    # Turns a stream of base rids into a stream of rows
+    :param rids: iterator            # base rids to read
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # yield tuples of the projected columns instead of Records
+    :param key: int                  # key to put on the Records, None reads it from the record
+    """
+    def _cursor(self, rids, projected_columns_index, raw, key=None):
+        pdir = self.table.page_directory
+        kcol = self.table.key
+        cols = [i for i in range(self.table.num_columns) if projected_columns_index[i]]
+        proj = projected_columns_index
+        fill_key = key is None and not raw
+        if fill_key and not proj[kcol]:
+            # always read the key so the Record can carry it
+            proj = list(proj)
+            proj[kcol] = 1
+        for rid in rids:
+            if rid not in pdir:
+                continue
+            vls = self._get_record_values(rid, 0, proj)
+            if raw:
+                yield tuple([vls[i] for i in cols])
+                continue
+            kv = key
+            if fill_key:
+                kv = vls[kcol]
+                if not projected_columns_index[kcol]:
+                    vls[kcol] = None
+            yield Record(rid, kv, vls)
+
+    """
+    # Select with several predicates joined by AND or OR
+    # each predicate is (column, value) for equality or (column, begin, end) for a range
+    # indexed predicates turn into rid sets that get intersected/unioned, anything left
+    # unindexed gets checked on just those columns, and if nothing is indexed (or an OR
+    # has an unindexed arm) it all happens in one columnar scan
+    :param predicates: list          # the predicate tuples
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param mode: str                 # 'and' or 'or'
+    """
+    def select_where(self, predicates, projected_columns_index, mode='and'):
+        try:
+            if mode not in ('and', 'or') or not predicates:
+                return False
+            idx = self.table.index
+            indexed = []
+            unindexed = []
+            # every lookup gets noted before any index is looked at, see _indexed
+            for p in predicates:
+                self._note_lookup(p[0], idx.indices[p[0]] is None)
+            for p in predicates:
+                if idx.indices[p[0]] is not None:
+                    indexed.append(p)
+                else:
+                    unindexed.append(p)
+
+            if not indexed or (mode == 'or' and unindexed):
+                return list(self._scan_where(predicates, projected_columns_index, mode))
+
+            sets = [self._pred_rids(p) for p in indexed]
+            if mode == 'or':
+                rids = set().union(*sets)
+            else:
+                sets.sort(key=len)
+                rids = set(sets[0])
+                for st in sets[1:]:
+                    if not rids:
+                        break
+                    rids.intersection_update(st)
+                if unindexed and rids:
+                    rids = self._filter_rids(rids, unindexed)
+            return list(self._cursor(sorted(rids), projected_columns_index, False))
+        except:
+            return False
+
+    """
+    # Turns one predicate into the set of rids the index gives for it
+    :param p: tuple          # (column, value) or (column, begin, end)
+    """
+    def _pred_rids(self, p):
+        if len(p) == 2:
+            return set(self.table.index.iter_locate(p[0], p[1]))
+        return set(self.table.index.iter_range(p[1], p[2], p[0]))
+
+    """
+    # Builds the value check for one predicate
+    :param p: tuple          # (column, value) or (column, begin, end)
+    """
+    def _pred_check(self, p):
+        if len(p) == 2:
+            val = p[1]
+            return lambda v: v == val
+        begin, end = p[1], p[2]
+        return lambda v: begin <= v <= end
+
+    """
+    # Keeps the rids that also pass the unindexed predicates, reading only their columns
+    :param rids: set         # candidate base rids
+    :param preds: list       # the unindexed predicates
+    """
+    def _filter_rids(self, rids, preds):
+        proj = [0] * self.table.num_columns
+        for p in preds:
+            proj[p[0]] = 1
+        checks = [(p[0], self._pred_check(p)) for p in preds]
+        out = set()
+        pdir = self.table.page_directory
+        for rid in rids:
+            if rid not in pdir:
+                continue
+            vls = self._get_record_values(rid, 0, proj)
+            if all(chk(vls[c]) for c, chk in checks):
+                out.add(rid)
+        return out
+
+    """
+    # Evaluates all predicates in one columnar scan and yields Records
+    :param predicates: list          # the predicate tuples
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param mode: str                 # 'and' or 'or'
+    """
+    def _scan_where(self, predicates, projected_columns_index, mode):
+        ncols = self.table.num_columns
+        kcol = self.table.key
+        cols = [i for i in range(ncols) if projected_columns_index[i]]
+        read = list(cols)
+        for c in [p[0] for p in predicates] + [kcol]:
+            if c not in read:
+                read.append(c)
+        pos = {c: j for j, c in enumerate(read)}
+        checks = [(pos[p[0]], self._pred_check(p)) for p in predicates]
+        combine = all if mode == 'and' else any
+        for rids, vals in self.table.scan_columns(read):
+            for i in range(len(rids)):
+                if not combine(chk(vals[j][i]) for j, chk in checks):
+                    continue
+                out = [None] * ncols
+                for c in cols:
+                    out[c] = vals[pos[c]][i]
+                yield Record(rids[i], vals[pos[kcol]][i], out)
+
+    """
+    # Equi-join of this table with another one, rows come back as tuples of this table's
+    # projected columns followed by the other table's
+    # hash join: the smaller table gets hashed on its join column straight off its pages,
+    # then the bigger one is probed a page at a time, both sides only read the columns needed
+    :param other: Query/Table        # the table to join with
+    :param column: int               # join column in this table
+    :param other_column: int         # join column in the other table
+    :param projected_columns_index: list  # 0/1 per column of this table
+    :param other_projected_columns_index: list  # 0/1 per column of the other table
+    """
+    def join(self, other, column, other_column, projected_columns_index, other_projected_columns_index):
+        try:
+            return list(self.join_iter(other, column, other_column, projected_columns_index, other_projected_columns_index))
+        except:
+            return False
+
+    """
+    # Cursor version of join, same arguments
+    """
+    def join_iter(self, other, column, other_column, projected_columns_index, other_projected_columns_index):
+        otbl = getattr(other, 'table', other)
+        left = (self.table, column, [i for i in range(self.table.num_columns) if projected_columns_index[i]])
+        right = (otbl, other_column, [i for i in range(otbl.num_columns) if other_projected_columns_index[i]])
+        build, probe = left, right
+        if self._live_records(otbl) < self._live_records(self.table):
+            build, probe = right, left
+        left_builds = build is left
+
+        hashed = {}
+        for jv, row in self._join_rows(build):
+            hashed.setdefault(jv, []).append(row)
+        if not hashed:
+            return
+        for jv, row in self._join_rows(probe):
+            matches = hashed.get(jv)
+            if matches is None:
+                continue
+            for m in matches:
+                if left_builds:
+                    yield m + row
+                else:
+                    yield row + m
+
+    """
+    # Streams (join value, projected tuple) for one side of a join off the columnar scan
+    :param side: tuple       # (table, join column, projected columns)
+    """
+    def _join_rows(self, side):
+        tbl, jcol, cols = side
+        read = list(cols)
+        if jcol not in read:
+            read.append(jcol)
+        jpos = read.index(jcol)
+        npos = len(cols)
+        for _, vals in tbl.scan_columns(read):
+            jv = vals[jpos]
+            picked = vals[:npos]
+            for i in range(len(jv)):
+                yield jv[i], tuple([c[i] for c in picked])
+
+    """
+    # How many live records a table has, the key index holds one entry per record
+    :param tbl: Table        # the table
+    """
+    def _live_records(self, tbl):
+        return len(tbl.index.indices[tbl.key])
+
+    """
+    # Returns the k records with the largest (or smallest) values in a column
+    # with an index on the column we walk the sorted keys from the right end and stop after
+    # k hits, otherwise a bounded heap runs over the columnar scan, memory stays O(k) either way
+    :param column: int               # the column to order by
+    :param k: int                    # how many records
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param where: list               # optional AND of predicates like select_where takes
+    :param largest: bool             # False gives the k smallest
+    """
+    def top_k(self, column, k, projected_columns_index, where=None, largest=True):
+        try:
+            if k <= 0:
                 return []
+            where = where or []
+            if self._indexed(column):
+                return self._ordered_by_index(column, k, projected_columns_index, where, largest)
+            rows = self._ordered_candidates(column, projected_columns_index, where)
+            pick = nlargest if largest else nsmallest
+            return [rec for _, _, rec in pick(k, rows)]
+        except:
+            return False
 
-            res = []
-            for rid in rid_list:
-                if rid not in self.table.page_directory:
+    """
+    # ORDER BY column [DESC] LIMIT n, without a limit the whole result has to be sorted
+    :param column: int               # the column to order by
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param limit: int                # max number of records, None means all
+    :param descending: bool          # largest first
+    :param where: list               # optional AND of predicates like select_where takes
+    """
+    def select_ordered(self, column, projected_columns_index, limit=None, descending=False, where=None):
+        try:
+            if limit is not None:
+                return self.top_k(column, limit, projected_columns_index, where, descending)
+            rows = sorted(self._ordered_candidates(column, projected_columns_index, where or []), reverse=descending)
+            return [rec for _, _, rec in rows]
+        except:
+            return False
+
+    """
+    # Walks the column's index in order, reading records until k of them pass the filter
+    :param column: int               # the column to order by
+    :param k: int                    # how many records
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param where: list               # AND of predicates
+    :param largest: bool             # walk from the largest key down
+    """
+    def _ordered_by_index(self, column, k, projected_columns_index, where, largest):
+        kcol = self.table.key
+        proj = list(projected_columns_index)
+        for c in [p[0] for p in where] + [kcol]:
+            proj[c] = 1
+        checks = [(p[0], self._pred_check(p)) for p in where]
+        pdir = self.table.page_directory
+        res = []
+        for _, rid in self.table.index.iter_ordered(column, largest):
+            if rid not in pdir:
+                continue
+            vls = self._get_record_values(rid, 0, proj)
+            if not all(chk(vls[c]) for c, chk in checks):
+                continue
+            kv = vls[kcol]
+            out = [vls[i] if projected_columns_index[i] else None for i in range(self.table.num_columns)]
+            res.append(Record(rid, kv, out))
+            if len(res) >= k:
+                break
+        return res
+
+    """
+    # Yields (order value, rid, Record) for every record passing the filter off the columnar scan
+    :param column: int               # the column to order by
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param where: list               # AND of predicates
+    """
+    def _ordered_candidates(self, column, projected_columns_index, where):
+        ncols = self.table.num_columns
+        kcol = self.table.key
+        cols = [i for i in range(ncols) if projected_columns_index[i]]
+        read = list(cols)
+        for c in [column, kcol] + [p[0] for p in where]:
+            if c not in read:
+                read.append(c)
+        pos = {c: j for j, c in enumerate(read)}
+        checks = [(pos[p[0]], self._pred_check(p)) for p in where]
+        for rids, vals in self.table.scan_columns(read):
+            ov = vals[pos[column]]
+            for i in range(len(rids)):
+                if checks and not all(chk(vals[j][i]) for j, chk in checks):
                     continue
+                out = [None] * ncols
+                for c in cols:
+                    out[c] = vals[pos[c]][i]
+                yield ov[i], rids[i], Record(rids[i], vals[pos[kcol]][i], out)
 
-                avals = self._get_record_values(rid)
-                out_cols = []
-                for i in range(self.table.num_columns):
-                    if projected_columns_index[i] == 1:
-                        out_cols.append(avals[i])
+    """
+    # Builds a reusable select for one column and projection, call it with the search value
+    # the access path and page columns are resolved once and re-planned on create/drop_index
+    :param column: int               # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param raw: bool                 # return tuples of the projected columns instead of Records
+    """
+    def prepare_select(self, column, projected_columns_index, raw=False):
+        return PreparedSelect(self, column, projected_columns_index, raw)
+
+    """
+    # Builds a reusable update by primary key, call it like update
+    """
+    def prepare_update(self):
+        return PreparedUpdate(self)
+
+    """
+    # Looks up a whole batch of keys at once, rids get sorted by (range, page) so each page
+    # is pinned once and all the slots we need from it get read in one go
+    # comes back as a flat list of Records in the order of the keys given
+    :param keys: list                # values we are searching for
+    :param column: int               # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    """
+    def select_many(self, keys, column, projected_columns_index):
+        try:
+            pdir = self.table.page_directory
+            hits = self._locate_many(keys, column)
+
+            # base pages first, anything with a newer tail gets pushed to the tail batch
+            by_page = {}
+            for rid in set(r for rl in hits.values() for r in rl):
+                locn = pdir.get(rid)
+                if locn is None:
+                    continue
+                rng_ix, _, pgnum, sl = locn
+                by_page.setdefault((rng_ix, pgnum), []).append((sl, rid))
+
+            vals = {}
+            by_tail = {}
+            for (rng_ix, pgnum) in sorted(by_page):
+                prange = self.table.page_ranges[rng_ix]
+                slots = by_page[(rng_ix, pgnum)]
+                inds = prange.read_slots(False, pgnum, INDIRECTION_COLUMN, [sl for sl, _ in slots])
+                tps_v = prange.tps.get(pgnum, 0)
+                base_slots = []
+                for (sl, rid), ind in zip(slots, inds):
+                    tl = None if ind == NULL_RID or ind <= tps_v else pdir.get(ind)
+                    if tl is None:
+                        base_slots.append((sl, rid))
                     else:
-                        out_cols.append(None)
+                        by_tail.setdefault((tl[0], tl[2]), []).append((tl[3], rid))
+                self._read_batch(prange, False, pgnum, base_slots, projected_columns_index, vals)
 
-                res.append(Record(rid, search_key, out_cols))
+            for (ti, tpg) in sorted(by_tail):
+                self._read_batch(self.table.page_ranges[ti], True, tpg, by_tail[(ti, tpg)], projected_columns_index, vals)
+
+            res = []
+            for k in keys:
+                for rid in hits.get(k, ()):
+                    if rid in vals:
+                        res.append(Record(rid, k, vals[rid]))
             return res
         except:
             return False
 
+    """
+    # Reads the projected columns for a group of slots that all sit on the same page
+    :param prange: PageRange # the page range the page belongs to
+    :param is_tail: bool     # tail or base page
+    :param pgnum: int        # which page
+    :param slots: list       # (slot, base rid) pairs
+    :param proj: list        # 0/1 per column
+    :param out: dict         # base rid -> column values, filled in here
+    """
+    def _read_batch(self, prange, is_tail, pgnum, slots, proj, out):
+        if not slots:
+            return
+        sl_list = [sl for sl, _ in slots]
+        cols = []
+        for i in range(self.table.num_columns):
+            if proj[i]:
+                cols.append(prange.read_slots(is_tail, pgnum, NUM_META_COLS + i, sl_list))
+            else:
+                cols.append(None)
+        for j in range(len(slots)):
+            out[slots[j][1]] = [None if c is None else c[j] for c in cols]
+
+    """
+    # Resolves a batch of keys to rids, with no index we do one scan for the whole batch
+    :param keys: list        # values we are searching for
+    :param column: int       # which column to search in
+    """
+    def _locate_many(self, keys, column):
+        hits = {}
+        if self._indexed(column):
+            for k in keys:
+                if k not in hits:
+                    hits[k] = self.table.index.locate(column, k)
+            return hits
+        want = set(keys)
+        for rids, vals in self.table.scan_columns([column]):
+            cv = vals[0]
+            for i in range(len(rids)):
+                if cv[i] in want:
+                    hits.setdefault(cv[i], []).append(rids[i])
+        return hits
+
+    """
+    # Turns primary keys into (position in input, base rid) sorted by where the record lives
+    :param keys: list        # primary keys
+    """
+    def _sorted_by_location(self, keys):
+        pdir = self.table.page_directory
+        todo = []
+        for i in range(len(keys)):
+            rid_list = self.table.index.locate(self.table.key, keys[i])
+            if not rid_list:
+                continue
+            locn = pdir.get(rid_list[0])
+            if locn is None:
+                continue
+            todo.append((locn[0], locn[2], locn[3], i, rid_list[0]))
+        todo.sort()
+        return [(t[3], t[4]) for t in todo]
+
     """
     # Same as select except this function allows us to search for previous tail records
     :param search_key: int           # value we are searching for
@@ -202,15 +1050,7 @@ class Query:
                 if rid not in self.table.page_directory:
                     continue
 
-                avals = self._get_record_values(rid, relative_version)
-
-                out_cols = []
-                for i in range(self.table.num_columns):
-                    if projected_columns_index[i] == 1:
-                        out_cols.append(avals[i])
-                    else:
-                        out_cols.append(None)
-
+                out_cols = self._get_record_values(rid, relative_version, projected_columns_index)
                 res.append(Record(rid, search_key, out_cols))
             return res
         except:
@@ -228,8 +1068,34 @@ class Query:
             rid_list = self.table.index.locate(self.table.key, primary_key)
             if not rid_list:
                 return False
+            return self._update_rid(rid_list[0], primary_key, columns)
+        except:
+            return False
 
-            br = rid_list[0]
+    """
+    # Applies a bunch of updates, sorted by where the records live so pages get hit in order
+    # updates to the same key still happen in the order they were given
+    :param updates: list     # (primary_key, columns) pairs, columns like the *columns of update
+    """
+    def update_many(self, updates):
+        res = [False] * len(updates)
+        keys = [u[0] for u in updates]
+        for i, rid in self._sorted_by_location(keys):
+            try:
+                res[i] = self._update_rid(rid, updates[i][0], updates[i][1])
+            except:
+                res[i] = False
+        return res
+
+    """
+    # Does the actual update once we know the base rid, writes one tail record
+    :param br: int           # base rid of the record
+    :param primary_key: int  # primary key it was looked up with
+    :param columns: tuple    # new values, None means leave it alone
+    :param fns: dict         # optional col -> function of the current value, for read-modify-write
+    """
+    def _update_rid(self, br, primary_key, columns, fns=None):
+        with self._writing(), self.table.latch_for(br):
             if br not in self.table.page_directory:
                 return False
 
@@ -260,12 +1126,18 @@ class Query:
                 if columns[i] is not None:
                     new_vals[i] = columns[i]
                     schema |= (1 << i)
+            if fns:
+                for i, fn in fns.items():
+                    new_vals[i] = fn(cur_vals[i])
+                    schema |= (1 << i)
+                    if i == self.table.key and new_vals[i] != primary_key:
+                        return False
 
             tail_rid = self.table.new_rid()
             tail_row = [0] * self.table.total_cols
             tail_row[INDIRECTION_COLUMN] = old_ind
             tail_row[RID_COLUMN] = tail_rid
-            tail_row[TIMESTAMP_COLUMN] = int(time())
+            tail_row[TIMESTAMP_COLUMN] = clock.now()
             tail_row[SCHEMA_ENCODING_COLUMN] = schema
             for i in range(self.table.num_columns):
                 tail_row[NUM_META_COLS + i] = new_vals[i]
@@ -274,18 +1146,77 @@ class Query:
             self.table.page_directory[tail_rid] = (rng_ix, True, tpg, tslot)
 
             prange.set_base_val(pgnum, sl, INDIRECTION_COLUMN, tail_rid)
+            ent = self.table.versions.get(br)
+            if ent is not None:
+                ent[0].append(tail_row[TIMESTAMP_COLUMN])
+                ent[1].append(tail_rid)
             old_schema = prange.get_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN)
             prange.set_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN, old_schema | schema)
 
             for i in range(self.table.num_columns):
-                if columns[i] is not None and self.table.index.indices[i] is not None:
+                if (columns[i] is not None or (fns and i in fns)) and self.table.index.maintained(i):
                     if cur_vals[i] != new_vals[i]:
                         self.table.index.update_entry(i, cur_vals[i], new_vals[i], br)
+            for col, summ in list(self.table.summaries.items()):
+                if columns[col] is not None or (fns and col in fns):
+                    summ.apply_delta(primary_key, new_vals[col] - cur_vals[col])
+            if self.table.row_cache is not None:
+                self.table.row_cache.refresh(primary_key, (br, tuple(new_vals)))
+            log = undo.current()
+            if log is not None:
+                log.push(self._undo_update, br, primary_key, old_ind, old_schema, tail_rid, cur_vals, new_vals)
+            if self.table.wal is not None:
+                # absolute values so replay doesnt depend on what was there before
+                self.table.wal.log(self.table.name, ['update', primary_key, [new_vals[i] if (schema >> i) & 1 else None for i in range(self.table.num_columns)]])
 
             self.table.maybe_trigger_merge(rng_ix)
             return True
-        except:
-            return False
+
+    """
+    # Takes one update back for a rollback: the base record points at the old version again
+    # and the tail record drops out of the page directory, indexes/summaries/cache follow
+    # once a merge has written into the base record (its original is saved) the old values
+    # go back there, the TPS may already cover the old version, before that the base still
+    # holds the original row and stays as it is
+    :param br: int           # base rid of the record
+    :param primary_key: int  # its primary key
+    :param old_ind: int      # indirection before the update
+    :param old_schema: int   # schema encoding before the update
+    :param tail_rid: int     # the tail record the update wrote
+    :param cur_vals: list    # values before the update
+    :param new_vals: list    # values after it
+    """
+    def _undo_update(self, br, primary_key, old_ind, old_schema, tail_rid, cur_vals, new_vals):
+        with self.table.latch_for(br):
+            locn = self.table.page_directory.get(br)
+            if locn is None:
+                return
+            rng_ix, _, pgnum, sl = locn
+            prange = self.table.page_ranges[rng_ix]
+            prange.set_base_val(pgnum, sl, INDIRECTION_COLUMN, old_ind)
+            merged = prange.get_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN) & ORIGINAL_SAVED
+            if merged:
+                for i in range(self.table.num_columns):
+                    prange.set_base_val(pgnum, sl, NUM_META_COLS + i, cur_vals[i])
+            if old_ind != NULL_RID:
+                # the copy of the original row hangs off an older tail and stays
+                old_schema |= merged
+            else:
+                # back to no tails at all, any copy went with the tail it hung off
+                self.table.versions.pop(br, None)
+            prange.set_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN, old_schema)
+            self.table.page_directory.pop(tail_rid, None)
+            ent = self.table.versions.get(br)
+            if ent is not None and ent[1] and ent[1][-1] == tail_rid:
+                ent[0].pop()
+                ent[1].pop()
+            for i in range(self.table.num_columns):
+                if cur_vals[i] != new_vals[i] and self.table.index.maintained(i):
+                    self.table.index.update_entry(i, new_vals[i], cur_vals[i], br)
+            for col, summ in list(self.table.summaries.items()):
+                summ.apply_delta(primary_key, cur_vals[col] - new_vals[col])
+            if self.table.row_cache is not None:
+                self.table.row_cache.invalidate(primary_key)
 
     """
     # Computes the sum of one column over all records who fall in a certain range
@@ -295,20 +1226,67 @@ class Query:
     """
     def sum(self, start_range, end_range, aggregate_column_index):
         try:
-            rid_list = self._locate_range(start_range, end_range, self.table.key)
-            if not rid_list:
+            summ = self.table.summaries.get(aggregate_column_index)
+            if summ is not None:
+                first, last = summ.full_blocks(start_range, end_range)
+                if first <= last:
+                    return self._summary_sum(summ, start_range, end_range, first, last)
+            tot, found = self._sum_records(start_range, end_range, aggregate_column_index)
+            if not found:
                 return False
-
-            tot = 0
-            for rid in rid_list:
-                if rid not in self.table.page_directory:
-                    continue
-                vls = self._get_record_values(rid)
-                tot = tot + vls[aggregate_column_index]
             return tot
         except:
             return False
 
+    """
+    # Range sum using a column summary: whole blocks come from the summary and only the
+    # keys at the two ragged ends get read record by record
+    :param summ: ColumnSummary       # the summary of the aggregated column
+    :param start_range: int          # lower bound of primary key range
+    :param end_range: int            # upper bound of primary key range
+    :param first: int                # first whole block
+    :param last: int                 # last whole block
+    """
+    def _summary_sum(self, summ, start_range, end_range, first, last):
+        cnt, tot = summ.combine(first, last)
+        found = cnt > 0
+        lo_tot, lo_found = self._sum_records(start_range, first * summ.block - 1, summ.col)
+        hi_tot, hi_found = self._sum_records((last + 1) * summ.block, end_range, summ.col)
+        if not (found or lo_found or hi_found):
+            return False
+        return tot + lo_tot + hi_tot
+
+    """
+    # Adds up a column record by record over a primary key range, returns (total, found_any)
+    :param start_range: int              # lower bound of primary key range
+    :param end_range: int                # upper bound of primary key range
+    :param aggregate_column_index: int   # the column index to sum
+    """
+    def _sum_records(self, start_range, end_range, aggregate_column_index):
+        proj = [0] * self.table.num_columns
+        proj[aggregate_column_index] = 1
+        tot = 0
+        found = False
+        if start_range > end_range:
+            return tot, found
+        kcol = self.table.key
+        if self._plan_range(start_range, end_range, kcol)['path'] == 'scan':
+            self._note_lookup(kcol, True)
+            for _, vals in self.table.scan_columns([kcol, aggregate_column_index]):
+                kv, cv = vals
+                for i in range(len(kv)):
+                    if start_range <= kv[i] <= end_range:
+                        found = True
+                        tot = tot + cv[i]
+            return tot, found
+        for rid in self._iter_locate_range(start_range, end_range, self.table.key):
+            found = True
+            if rid not in self.table.page_directory:
+                continue
+            vls = self._get_record_values(rid, 0, proj)
+            tot = tot + vls[aggregate_column_index]
+        return tot, found
+
     """
     # Same as sum but allows you to look back at tail records
     :param start_range: int              # lower bound of primary key range
@@ -318,29 +1296,231 @@ class Query:
     """
     def sum_version(self, start_range, end_range, aggregate_column_index, relative_version):
         try:
-            rid_list = self._locate_range(start_range, end_range, self.table.key)
-            if not rid_list:
+            proj = [0] * self.table.num_columns
+            proj[aggregate_column_index] = 1
+            tot = 0
+            found = False
+            for rid in self._iter_locate_range(start_range, end_range, self.table.key):
+                found = True
+                if rid not in self.table.page_directory:
+                    continue
+                vls = self._get_record_values(rid, relative_version, proj)
+                tot = tot + vls[aggregate_column_index]
+            if not found:
                 return False
+            return tot
+        except:
+            return False
+
+    """
+    # Like select but returns the records as they were at a point in time
+    # records that didnt exist yet at that time are left out, ones deleted since are not
+    # primary keys never change so those go through the index, any other column is matched
+    # on its value at that time, which means checking every record since the index and a
+    # scan both only know todays values
+    :param search_key: int           # value we are searching for
+    :param search_key_index: int     # which column to search in
+    :param projected_columns_index: list  # a list of 0s and 1s indicating which columns to return
+    :param timestamp: int            # the TIMESTAMP_COLUMN value to read as of (clock.now() ns)
+    """
+    def select_as_of(self, search_key, search_key_index, projected_columns_index, timestamp):
+        try:
+            col = search_key_index
+            if col == self.table.key:
+                rids = self._iter_locate(col, search_key)
+                dead = lambda: self.table.dead_records(search_key, search_key)
+            else:
+                rids = [rid for rid, locn in list(self.table.page_directory.items()) if not locn[1]]
+                dead = self.table.dead_records
+            proj = list(projected_columns_index)
+            proj[col] = 1
+            res = []
+            for rid, locn in self._as_of_locations(rids, dead, timestamp):
+                vls = self._get_record_values_as_of(rid, timestamp, proj, locn)
+                if vls is None or vls[col] != search_key:
+                    continue
+                out_cols = [vls[i] if projected_columns_index[i] else None for i in range(self.table.num_columns)]
+                res.append(Record(rid, search_key, out_cols))
+            return res
+        except:
+            return False
 
+    """
+    # Page directory entries of the records an as-of read has to look at: the live ones it
+    # found plus the ones deleted after the timestamp, which are gone from the directory and
+    # the indexes but were still there back then
+    # the tombstones are read after the live records, a delete leaves its tombstone before
+    # the record leaves the directory so one that races us shows up on one side or the other
+    :param rids: iterable            # base rids of live candidates
+    :param dead: function            # returns the tombstones (rid, locn, delete ts) to consider
+    :param timestamp: int            # the timestamp the read is as of
+    """
+    def _as_of_locations(self, rids, dead, timestamp):
+        pdir = self.table.page_directory
+        found = {}
+        for rid in rids:
+            locn = pdir.get(rid)
+            if locn is not None:
+                found[rid] = locn
+        for rid, locn, dts in dead():
+            if dts > timestamp:
+                found.setdefault(rid, locn)
+            else:
+                found.pop(rid, None)
+        return found.items()
+
+    """
+    # Like sum but adds up the values as they were at a point in time
+    :param start_range: int              # lower bound of primary key range
+    :param end_range: int                # upper bound of primary key range
+    :param aggregate_column_index: int   # the column index to sum
+    :param timestamp: int                # the TIMESTAMP_COLUMN value to read as of (clock.now() ns)
+    """
+    def sum_as_of(self, start_range, end_range, aggregate_column_index, timestamp):
+        try:
+            proj = [0] * self.table.num_columns
+            proj[aggregate_column_index] = 1
             tot = 0
-            for rid in rid_list:
-                if rid not in self.table.page_directory:
+            found = False
+            rids = self._iter_locate_range(start_range, end_range, self.table.key)
+            dead = lambda: self.table.dead_records(start_range, end_range)
+            for rid, locn in self._as_of_locations(rids, dead, timestamp):
+                vls = self._get_record_values_as_of(rid, timestamp, proj, locn)
+                if vls is None:
                     continue
-                vls = self._get_record_values(rid, relative_version)
+                found = True
                 tot = tot + vls[aggregate_column_index]
+            if not found:
+                return False
             return tot
         except:
             return False
+
+    """
+    # General aggregate over any column, runs on the columnar scan one page at a time
+    # each page gets reduced with builtin sum/min/max over the column list, tail versions
+    # are already resolved in batch by the scan
+    # without group_by you get a single value, with it a dict of group value -> result
+    # empty input gives 0 for count/sum and None for min/max/avg
+    :param func: str                 # one of 'count', 'sum', 'min', 'max', 'avg'
+    :param column: int               # the column to aggregate
+    :param group_by: int             # optional column to group on
+    :param where_column: int         # optional column to filter on
+    :param begin: int                # lower bound for where_column (inclusive)
+    :param end: int                  # upper bound for where_column (inclusive), same as begin for equality
+    """
+    def aggregate(self, func, column, group_by=None, where_column=None, begin=None, end=None):
+        try:
+            if func not in AGGREGATES:
+                return False
+            if where_column is not None:
+                if begin is None:
+                    begin = end
+                if end is None:
+                    end = begin
+                self._note_lookup(where_column, self.table.index.indices[where_column] is None)
+            cols = [column]
+            if group_by is not None:
+                cols.append(group_by)
+            if where_column is not None:
+                cols.append(where_column)
+            wpos = len(cols) - 1
+
+            groups = {}
+            for _, vals in self.table.scan_columns(cols):
+                cv = vals[0]
+                if where_column is not None:
+                    wv = vals[wpos]
+                    keep = [i for i in range(len(wv)) if begin <= wv[i] <= end]
+                    if not keep:
+                        continue
+                    if len(keep) < len(cv):
+                        vals = [[c[i] for i in keep] for c in vals]
+                        cv = vals[0]
+                if group_by is None:
+                    self._fold(groups, None, cv)
+                    continue
+                split = {}
+                gv = vals[1]
+                for i in range(len(cv)):
+                    split.setdefault(gv[i], []).append(cv[i])
+                for g, part in split.items():
+                    self._fold(groups, g, part)
+
+            if group_by is None:
+                return self._finish(func, groups.get(None))
+            return {g: self._finish(func, acc) for g, acc in groups.items()}
+        except:
+            return False
+
+    """
+    # Folds one chunk of values into the running [count, sum, min, max] for a group
+    :param groups: dict      # group -> [count, sum, min, max]
+    :param g: int            # group value (None when not grouping)
+    :param chunk: list       # the values to fold in
+    """
+    def _fold(self, groups, g, chunk):
+        if not chunk:
+            return
+        acc = groups.get(g)
+        cmin = min(chunk)
+        cmax = max(chunk)
+        if acc is None:
+            groups[g] = [len(chunk), sum(chunk), cmin, cmax]
+            return
+        acc[0] = acc[0] + len(chunk)
+        acc[1] = acc[1] + sum(chunk)
+        if cmin < acc[2]:
+            acc[2] = cmin
+        if cmax > acc[3]:
+            acc[3] = cmax
+
+    """
+    # Turns a [count, sum, min, max] accumulator into the answer for func
+    :param func: str         # which aggregate
+    :param acc: list         # the accumulator, None if nothing matched
+    """
+    def _finish(self, func, acc):
+        if acc is None:
+            return 0 if func in ('count', 'sum') else None
+        if func == 'count':
+            return acc[0]
+        if func == 'sum':
+            return acc[1]
+        if func == 'min':
+            return acc[2]
+        if func == 'max':
+            return acc[3]
+        return acc[1] / acc[0]
+
     """
     # Adds 1 to a single column of the record identified by the primary key
     :param key: int          # primary key value of the record you want to update
     :param column: int       # the column index to increment
     """
     def increment(self, key, column):
-        r = self.select(key, self.table.key, [1] * self.table.num_columns)[0]
-        if r is not False:
-            upd_cols = [None] * self.table.num_columns
-            upd_cols[column] = r[column] + 1
-            u = self.update(key, *upd_cols)
-            return u
-        return False
+        return self.add(key, column, 1)
+
+    """
+    # Read-modify-write on one record: locates it once and, while holding the record latch,
+    # reads the current values, runs each function on its column and writes one tail record
+    :param key: int          # primary key value of the record
+    :param fns: dict         # column -> function taking the current value and returning the new one
+    """
+    def apply(self, key, fns):
+        try:
+            rid_list = self.table.index.locate(self.table.key, key)
+            if not rid_list:
+                return False
+            return self._update_rid(rid_list[0], key, [None] * self.table.num_columns, fns)
+        except:
+            return False
+
+    """
+    # Atomically adds delta to one column of a record
+    :param key: int          # primary key value of the record
+    :param column: int       # the column index to add to
+    :param delta: int        # how much to add
+    """
+    def add(self, key, column, delta):
+        return self.apply(key, {column: lambda v: v + delta})
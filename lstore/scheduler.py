@@ -0,0 +1,140 @@
+import threading
+from lstore.transaction import POINT_READS, KEY_WRITES, TABLE_WRITES
+from lstore.config import NUM_WORKERS
+
+"""
+# deterministic batch scheduling: the keys every transaction in a batch will touch are read
+# off its queries before anything runs, transactions that share a key somebody writes end
+# up in the same group (union find over the keys), groups run in parallel and each one
+# runs its transactions one after the other in submission order
+# no two groups touch the same written key so nothing needs a lock, nothing waits and
+# nothing aborts because of another transaction, and the outcome is the one running the
+# batch serially in submission order would give
+# a query whose keys cant be known up front (range reads, non key lookups, bulk writes)
+# counts as touching its whole table
+"""
+
+# reads whose records cant be named before they run
+TABLE_READS = ('select_range', 'select_range_iter', 'select_where', 'select_many', 'join', 'join_iter',
+               'top_k', 'select_ordered', 'sum', 'sum_version', 'sum_as_of', 'aggregate', 'explain')
+
+
+"""
+# The (table name, key) pairs one transaction reads and writes, key None is the whole table
+:param txn: Transaction     # a transaction built with add_query
+"""
+def access_sets(txn):
+    reads = set()
+    writes = set()
+    for query, table, args in txn.queries:
+        tn = table.name
+        name = getattr(query, '__name__', '')
+        if name in POINT_READS:
+            reads.add((tn, args[0] if args[1] == table.key else None))
+        elif name == 'insert':
+            writes.add((tn, args[table.key]))
+        elif name in KEY_WRITES:
+            writes.add((tn, args[0]))
+            if name == 'update' and args[1 + table.key] is not None:
+                writes.add((tn, args[1 + table.key]))
+            elif name == 'apply' and table.key in args[1]:
+                writes.add((tn, None))
+        elif name in TABLE_WRITES:
+            writes.add((tn, None))
+        elif name in TABLE_READS:
+            reads.add((tn, None))
+        else:
+            # something we dont know, assume the worst
+            writes.add((tn, None))
+    return reads, writes
+
+
+"""
+# Splits a batch into groups that can run at the same time, each group keeps submission
+# order and the groups come back ordered by their first transaction
+:param transactions: list   # the batch
+"""
+def conflict_groups(transactions):
+    sets = [access_sets(txn) for txn in transactions]
+    # a table anybody touches as a whole gets tracked as one resource
+    wide = set()
+    for reads, writes in sets:
+        for tn, key in reads | writes:
+            if key is None:
+                wide.add(tn)
+    # only resources somebody writes can make two transactions conflict
+    written = set()
+    for _, writes in sets:
+        for tn, key in writes:
+            written.add((tn, None if tn in wide else key))
+
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while x != root:
+            nxt = parent.get(x, x)
+            parent[x] = root
+            x = nxt
+        return root
+
+    for i, (reads, writes) in enumerate(sets):
+        for tn, key in reads | writes:
+            res = (tn, None if tn in wide else key)
+            if res in written:
+                a, b = find(i), find(res)
+                if a != b:
+                    parent[b] = a
+
+    groups = {}
+    for i, txn in enumerate(transactions):
+        groups.setdefault(find(i), []).append(txn)
+    return list(groups.values())
+
+
+class BatchScheduler:
+    """
+    # Runs one batch of transactions group by group on a set of worker threads
+    :param transactions: list   # the batch, in the order it was submitted
+    """
+    def __init__(self, transactions):
+        self.transactions = list(transactions)
+        self.groups = conflict_groups(self.transactions)
+        self.results = [None] * len(self.transactions)     # run_unlocked result per transaction
+        self._pos = {id(txn): i for i, txn in enumerate(self.transactions)}
+        # biggest groups get started first so one long group doesnt end up last
+        self.order = sorted(self.groups, key=len, reverse=True)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    """
+    # Runs the batch and waits for it, returns commits, aborts (queries that failed), the
+    # number of groups and the size of the largest one, which bounds the speedup
+    :param num_workers: int     # worker threads the groups are spread over
+    """
+    def run(self, num_workers=NUM_WORKERS):
+        threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, min(num_workers, len(self.groups))))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        commits = sum(1 for r in self.results if r)
+        return {
+            'commits': commits,
+            'aborts': len(self.results) - commits,
+            'groups': len(self.groups),
+            'largest_group': max((len(g) for g in self.groups), default=0),
+        }
+
+    # takes groups off the list until there are none left
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._next >= len(self.order):
+                    return
+                group = self.order[self._next]
+                self._next = self._next + 1
+            for txn in group:
+                self.results[self._pos[id(txn)]] = txn.run_unlocked()
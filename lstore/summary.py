@@ -0,0 +1,81 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from lstore.config import SUMMARY_BLOCK_KEYS
+
+"""
+# pre-aggregated count/sum of one column per block of primary keys
+# block b covers keys [b * block, (b + 1) * block - 1], so a range sum can add up whole
+# blocks and only has to touch records at the two ragged ends
+# Query keeps it up to date on insert/update/delete, merge never changes the latest
+# values so theres nothing to do there
+"""
+class ColumnSummary:
+    def __init__(self, col, block=SUMMARY_BLOCK_KEYS):
+        self.col = col
+        self.block = block
+        self.blocks = {}        # block id -> [count, sum]
+        self.block_ids = []     # sorted block ids that have at least one record
+        self._lock = threading.Lock()
+
+    """
+    # Adds a record (or takes one away when sign is -1)
+    :param key: int     # primary key of the record
+    :param val: int     # its value in the summarized column
+    :param sign: int    # 1 to add, -1 to remove
+    """
+    def add(self, key, val, sign=1):
+        b = key // self.block
+        with self._lock:
+            acc = self.blocks.get(b)
+            if acc is None:
+                acc = [0, 0]
+                self.blocks[b] = acc
+                insort(self.block_ids, b)
+            acc[0] = acc[0] + sign
+            acc[1] = acc[1] + sign * val
+            if acc[0] <= 0:
+                del self.blocks[b]
+                ix = bisect_left(self.block_ids, b)
+                if ix < len(self.block_ids) and self.block_ids[ix] == b:
+                    self.block_ids.pop(ix)
+
+    """
+    # Applies the change of an updated value
+    :param key: int     # primary key of the record
+    :param delta: int   # new value - old value
+    """
+    def apply_delta(self, key, delta):
+        if delta == 0:
+            return
+        with self._lock:
+            acc = self.blocks.get(key // self.block)
+            if acc is not None:
+                acc[1] = acc[1] + delta
+
+    """
+    # Splits [begin, end] into the part covered by whole blocks and the ragged edges
+    # returns (first_full_block, last_full_block), first > last when no block is whole
+    :param begin: int   # lower bound of the key range
+    :param end: int     # upper bound of the key range
+    """
+    def full_blocks(self, begin, end):
+        first = -((-begin) // self.block)
+        last = (end + 1) // self.block - 1
+        return first, last
+
+    """
+    # Returns (count, sum) over the whole blocks first..last
+    :param first: int   # first block id
+    :param last: int    # last block id
+    """
+    def combine(self, first, last):
+        cnt = 0
+        tot = 0
+        with self._lock:
+            lo = bisect_left(self.block_ids, first)
+            hi = bisect_right(self.block_ids, last)
+            for b in self.block_ids[lo:hi]:
+                acc = self.blocks[b]
+                cnt = cnt + acc[0]
+                tot = tot + acc[1]
+        return cnt, tot
@@ -1,8 +1,17 @@
 import threading
+from contextlib import nullcontext
 from lstore.index import Index
+from lstore.lock_manager import LockManager
+from lstore.advisor import IndexAdvisor
+from lstore.summary import ColumnSummary
+from lstore.cache import RowCache, VersionCache
+from bisect import bisect_right
 from lstore.config import *
 
 class Record:
+    # no per instance __dict__, selects make a lot of these
+    __slots__ = ('rid', 'key', 'columns')
+
     """
     #Creates Record object
     """
@@ -29,6 +38,10 @@ class PageRange:
         self.num_base_records = 0
         self.num_tail_records = 0
         self.tps = {}
+        # guards handing out slots so two writers never get the same one
+        self.latch = threading.Lock()
+        # base page -> bitmap of deleted slots, lets scans and merge skip them without reading
+        self.deleted = {}
 
     """
     #Creates a unique identifier (ID) for a specific page
@@ -53,17 +66,14 @@ class PageRange:
     :param vals: list     #corresponds to column's value
     """
     def add_base_record(self, vals):
-        pgnum = self.num_base_records // RECORDS_PER_PAGE
-        sl = self.num_base_records % RECORDS_PER_PAGE
+        with self.latch:
+            n = self.num_base_records
+            self.num_base_records = n + 1
+        pgnum = n // RECORDS_PER_PAGE
+        sl = n % RECORDS_PER_PAGE
+        write_value = self.bufferpool.write_value
         for col_ix in range(self.num_cols):
-            page_id = self._page_id(False, pgnum, col_ix)
-            pg = self.bufferpool.get_page(page_id)
-            pg.write_at(sl, vals[col_ix])
-            if pg.num_records <= sl:
-                pg.num_records = sl + 1
-            self.bufferpool.mark_dirty(page_id)
-            self.bufferpool.unpin(page_id)
-        self.num_base_records = self.num_base_records + 1
+            write_value(self._page_id(False, pgnum, col_ix), sl, vals[col_ix])
         return pgnum, sl
 
 
@@ -72,17 +82,14 @@ class PageRange:
     :param vals: list     #column's value
     """
     def add_tail_record(self, vals):
-        pgnum = self.num_tail_records // RECORDS_PER_PAGE
-        sl = self.num_tail_records % RECORDS_PER_PAGE
+        with self.latch:
+            n = self.num_tail_records
+            self.num_tail_records = n + 1
+        pgnum = n // RECORDS_PER_PAGE
+        sl = n % RECORDS_PER_PAGE
+        write_value = self.bufferpool.write_value
         for col_ix in range(self.num_cols):
-            page_id = self._page_id(True, pgnum, col_ix)
-            pg = self.bufferpool.get_page(page_id)
-            pg.write_at(sl, vals[col_ix])
-            if pg.num_records <= sl:
-                pg.num_records = sl + 1
-            self.bufferpool.mark_dirty(page_id)
-            self.bufferpool.unpin(page_id)
-        self.num_tail_records = self.num_tail_records + 1
+            write_value(self._page_id(True, pgnum, col_ix), sl, vals[col_ix])
         return pgnum, sl
 
 
@@ -114,10 +121,14 @@ class PageRange:
     :param slot: int     #which record position within that page
     :param start_col: int     #starting column index
     :param num_cols: int     #how many columns to read
+    :param proj: list     #optional 0/1 per column, pages for 0 columns are never touched and come back as None
     """
-    def get_base_vals(self, pg, slot, start_col, num_cols):
+    def get_base_vals(self, pg, slot, start_col, num_cols, proj=None):
         vlist = []
         for i in range(num_cols):
+            if proj is not None and not proj[i]:
+                vlist.append(None)
+                continue
             page_id = self._page_id(False, pg, start_col + i)
             vlist.append(self.bufferpool.read_value(page_id, slot))
         return vlist
@@ -129,10 +140,14 @@ class PageRange:
     :param slot: int     #which record position within that page
     :param start_col: int     #starting column index
     :param num_cols: int     #how many columns to read
+    :param proj: list     #optional 0/1 per column, pages for 0 columns are never touched and come back as None
     """
-    def get_tail_vals(self, pg, slot, start_col, num_cols):
+    def get_tail_vals(self, pg, slot, start_col, num_cols, proj=None):
         vlist = []
         for i in range(num_cols):
+            if proj is not None and not proj[i]:
+                vlist.append(None)
+                continue
             page_id = self._page_id(True, pg, start_col + i)
             vlist.append(self.bufferpool.read_value(page_id, slot))
         return vlist
@@ -146,11 +161,114 @@ class PageRange:
     :param val: any (depending on the column)     #the value being inserted
     """
     def set_base_val(self, pg, slot, col, val):
-        page_id = self._page_id(False, pg, col)
+        self.bufferpool.write_value(self._page_id(False, pg, col), slot, val)
+
+
+    """
+    #Writes val into tail page pg, column col, at position slot
+    :param pg: int     #which tail page
+    :param slot: int     #which record position within the page
+    :param col: int     #which column
+    :param val: int     #the value being written
+    """
+    def set_tail_val(self, pg, slot, col, val):
+        self.bufferpool.write_value(self._page_id(True, pg, col), slot, val)
+
+
+    """
+    #Sets the delete bit of a base slot
+    :param pg: int     #which base page
+    :param slot: int     #which slot
+    """
+    def mark_deleted(self, pg, slot):
+        with self.latch:
+            self.deleted[pg] = self.deleted.get(pg, 0) | (1 << slot)
+
+    """
+    #Clears the delete bit of a base slot again
+    :param pg: int     #which base page
+    :param slot: int     #which slot
+    """
+    def clear_deleted(self, pg, slot):
+        with self.latch:
+            bits = self.deleted.get(pg, 0) & ~(1 << slot)
+            if bits:
+                self.deleted[pg] = bits
+            else:
+                self.deleted.pop(pg, None)
+
+    """
+    #Returns the slots of the first n on a base page that arent marked deleted
+    :param pg: int     #which base page
+    :param n: int     #how many slots the page has in use
+    """
+    def live_slots(self, pg, n):
+        bits = self.deleted.get(pg, 0)
+        if not bits:
+            return range(n)
+        if bits == (1 << n) - 1:
+            return ()
+        return [sl for sl in range(n) if not (bits >> sl) & 1]
+
+    """
+    #Reads a list of slots from one column page, the page only gets pinned once
+    :param is_tail: boolean     #tail page or base page
+    :param pg: int     #which page inside the page range
+    :param col: int     #which column
+    :param slots: list     #slot numbers to read
+    """
+    def read_slots(self, is_tail, pg, col, slots):
+        page_id = self._page_id(is_tail, pg, col)
+        page_obj = self.bufferpool.get_page(page_id)
+        try:
+            return [page_obj.read(sl) for sl in slots]
+        finally:
+            self.bufferpool.unpin(page_id)
+
+
+    """
+    #Reads the first n slots of one column page in a single shot and returns them as a list
+    #the page bytes get viewed as int64s through a memoryview so theres no per value unpack
+    :param is_tail: boolean     #tail page or base page
+    :param pg: int     #which page inside the page range
+    :param col: int     #which column
+    :param n: int     #how many slots to read
+    """
+    def read_column(self, is_tail, pg, col, n):
+        page_id = self._page_id(is_tail, pg, col)
         page_obj = self.bufferpool.get_page(page_id)
-        page_obj.write_at(slot, val)
-        self.bufferpool.mark_dirty(page_id)
-        self.bufferpool.unpin(page_id)
+        try:
+            return memoryview(page_obj.data).cast('q')[:n].tolist()
+        finally:
+            self.bufferpool.unpin(page_id)
+
+class PageDirectory(dict):
+    """
+    #rid -> (range_idx, is_tail, page, slot), a dict that also remembers which rids were
+    #written or removed since take_changes was last called, so a checkpoint only has to
+    #save those instead of the whole directory, reads are plain dict reads
+    """
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.changed = set()
+
+    def __setitem__(self, rid, locn):
+        dict.__setitem__(self, rid, locn)
+        self.changed.add(rid)
+
+    def __delitem__(self, rid):
+        dict.__delitem__(self, rid)
+        self.changed.add(rid)
+
+    def pop(self, rid, *default):
+        self.changed.add(rid)
+        return dict.pop(self, rid, *default)
+
+    #Hands back the changed rids and starts a fresh set
+    def take_changes(self):
+        taken = self.changed
+        self.changed = set()
+        return taken
 
 class Table:
     """
@@ -163,23 +281,47 @@ class Table:
         self.total_cols = num_columns + NUM_META_COLS
         self.bufferpool = bufferpool
         self.page_ranges = []
-        self.page_directory = {}
+        self.page_directory = PageDirectory()
         self.next_rid = 1
         self.merge_thread = None
+        self._rid_lock = threading.Lock()
+        self._range_lock = threading.Lock()
+        self.latches = [threading.Lock() for _ in range(LATCH_STRIPES)]
         self.index = Index(self)
+        self.advisor = IndexAdvisor(self)
+        self.summaries = {}     # col -> ColumnSummary
+        self.versions = VersionCache()  # base rid -> ([timestamps], [tail rids]) oldest first, built on demand
+        self.tombstones = {}    # primary key -> [(base rid, page directory entry, delete timestamp)]
+        self.row_cache = None   # optional RowCache of hot rows by primary key
+        self.lock_manager = LockManager()   # Database swaps in the one all its tables share
+        self.wal = None         # the database's WriteAheadLog once it has been opened
+        self.gate = None        # and its checkpoint WriteGate, every write passes it
 
     """
     #Generates a new unique record ID every time this method is called
     """
     def new_rid(self):
-        r = self.next_rid
-        self.next_rid = self.next_rid + 1
+        with self._rid_lock:
+            r = self.next_rid
+            self.next_rid = self.next_rid + 1
         return r
 
+    """
+    #Returns the latch that guards a record, hold it while reading and rewriting a record
+    #so a read-modify-write cant interleave with another write to the same record
+    :param rid: int     #base rid of the record
+    """
+    def latch_for(self, rid):
+        return self.latches[rid % LATCH_STRIPES]
+
     """
     #Decides which page range new records should go into
     """
     def _current_range(self):
+        with self._range_lock:
+            return self._pick_range()
+
+    def _pick_range(self):
         if len(self.page_ranges) == 0:
             self.page_ranges.append(PageRange(self.total_cols, table_name=self.name, range_idx=0, bufferpool=self.bufferpool))
             return 0, self.page_ranges[0]
@@ -190,8 +332,282 @@ class Table:
             return rng_ix, self.page_ranges[-1]
         return len(self.page_ranges) - 1, last
 
+    """
+    #Returns the version index of a record: its tail timestamps and tail rids, oldest first
+    #built the first time somebody asks by walking the tail chain once, after that update
+    #just appends to it so any version or timestamp is a list index / bisect away
+    :param base_rid: int     #base rid of the record
+    :param locn: tuple     #its page directory entry, for a deleted record thats its tombstone
+    """
+    def version_chain(self, base_rid, locn=None):
+        ent = self.versions.get(base_rid)
+        if ent is not None:
+            return ent
+        # built under the record latch, an update landing halfway through the walk would
+        # otherwise see no entry, skip its append and leave us caching a chain without it
+        with self.latch_for(base_rid):
+            ent = self.versions.get(base_rid)
+            if ent is not None:
+                return ent
+            pdir = self.page_directory
+            rng_ix, _, pgnum, sl = locn if locn is not None else pdir[base_rid]
+            prange = self.page_ranges[rng_ix]
+            ts_list = []
+            rid_list = []
+            curr = prange.get_base_val(pgnum, sl, INDIRECTION_COLUMN)
+            while curr != NULL_RID:
+                tl = pdir.get(curr)
+                if tl is None:
+                    break
+                ti, _, tpg, tslot = tl
+                tp = self.page_ranges[ti]
+                ts_list.append(tp.get_tail_val(tpg, tslot, TIMESTAMP_COLUMN))
+                rid_list.append(curr)
+                curr = tp.get_tail_val(tpg, tslot, INDIRECTION_COLUMN)
+            ts_list.reverse()
+            rid_list.reverse()
+            ent = (ts_list, rid_list)
+            self.versions.put(base_rid, ent)
+            return ent
+
+    """
+    #Finds which version of a record was current at a timestamp
+    #returns the tail rid, NULL_RID when it was still the base version, or None if the
+    #record didnt exist yet
+    :param base_rid: int     #base rid of the record
+    :param ts: int     #the timestamp we want to read as of
+    :param locn: tuple     #its page directory entry if its not in the directory anymore
+    """
+    def version_as_of(self, base_rid, ts, locn=None):
+        if locn is None:
+            locn = self.page_directory[base_rid]
+        rng_ix, _, pgnum, sl = locn
+        if self.page_ranges[rng_ix].get_base_val(pgnum, sl, TIMESTAMP_COLUMN) > ts:
+            return None
+        ts_list, rid_list = self.version_chain(base_rid, locn)
+        ix = bisect_right(ts_list, ts) - 1
+        if ix < 0:
+            return NULL_RID
+        return rid_list[ix]
+
+    """
+    #Remembers when a record was deleted, a delete takes the record out of the directory and
+    #the indexes but reads as of an earlier time (snapshot transactions) must still find it
+    #call before the directory entry goes so a reader that misses one finds the other
+    #kept in memory only, no snapshot outlives the process
+    :param key: int     #primary key of the record
+    :param rid: int     #its base rid
+    :param locn: tuple     #its page directory entry
+    :param ts: int     #when it was deleted
+    """
+    def add_tombstone(self, key, rid, locn, ts):
+        self.tombstones.setdefault(key, []).append((rid, locn, ts))
+
+    """
+    #Forgets a tombstone again when a delete gets rolled back
+    :param key: int     #primary key of the record
+    :param rid: int     #its base rid
+    """
+    def drop_tombstone(self, key, rid):
+        dead = self.tombstones.get(key)
+        if dead is None:
+            return
+        dead = [t for t in dead if t[0] != rid]
+        if dead:
+            self.tombstones[key] = dead
+        else:
+            self.tombstones.pop(key, None)
+
+    """
+    #Tombstones of the deleted records whose primary key is in [begin, end], all of them
+    #without bounds
+    :param begin: int     #lower bound of the key range
+    :param end: int     #upper bound of the key range
+    """
+    def dead_records(self, begin=None, end=None):
+        if begin is not None and begin == end:
+            return list(self.tombstones.get(begin, ()))
+        out = []
+        for key, dead in list(self.tombstones.items()):
+            if begin is None or begin <= key <= end:
+                out.extend(dead)
+        return out
+
+    """
+    #Timestamp of the newest version of a record, snapshot transactions compare it with
+    #their start timestamp to catch write-write conflicts
+    #read off the newest tail directly, building a version index for every record a
+    #transaction writes would only fill the cache with chains nobody reads
+    :param base_rid: int     #base rid of the record
+    """
+    def last_modified(self, base_rid):
+        rng_ix, _, pgnum, sl = self.page_directory[base_rid]
+        prange = self.page_ranges[rng_ix]
+        ind = prange.get_base_val(pgnum, sl, INDIRECTION_COLUMN)
+        tl = self.page_directory.get(ind) if ind != NULL_RID else None
+        if tl is None:
+            return prange.get_base_val(pgnum, sl, TIMESTAMP_COLUMN)
+        ti, _, tpg, tslot = tl
+        return self.page_ranges[ti].get_tail_val(tpg, tslot, TIMESTAMP_COLUMN)
+
+    """
+    #Turns on the hot row cache for this table
+    :param capacity: int     #how many rows it can hold
+    """
+    def enable_row_cache(self, capacity=ROW_CACHE_CAPACITY):
+        if self.row_cache is None:
+            self.row_cache = RowCache(capacity)
+        return self.row_cache
+
+    def disable_row_cache(self):
+        self.row_cache = None
+
+    """
+    #Turns on a pre-aggregated per key block summary for a column so range sums over it
+    #only have to read the records at the edges, built from one columnar scan
+    :param col: int     #user column number
+    :param block: int     #how many keys one block covers
+    """
+    def enable_summary(self, col, block=SUMMARY_BLOCK_KEYS):
+        if col in self.summaries:
+            return self.summaries[col]
+        summ = ColumnSummary(col, block)
+        for _, vals in self.scan_columns([self.key, col]):
+            kv, cv = vals
+            for i in range(len(kv)):
+                summ.add(kv[i], cv[i])
+        self.summaries[col] = summ
+        return summ
+
+    """
+    #Drops a column summary
+    :param col: int     #user column number
+    """
+    def disable_summary(self, col):
+        self.summaries.pop(col, None)
+
+    """
+    #Columnar scan, goes one base page at a time and yields (rids, values) with the latest
+    #version of each requested column for every live record on that page
+    #only slots whose indirection is newer than the page TPS get resolved through the tail,
+    #and those get batched so each tail page is read once per column
+    :param cols: list     #user column numbers to read
+    """
+    def scan_columns(self, cols):
+        pdir = self.page_directory
+        for rng_ix in range(len(self.page_ranges)):
+            prange = self.page_ranges[rng_ix]
+            nrec = prange.num_base_records
+            npages = (nrec + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE
+            for pg_idx in range(npages):
+                n = min(RECORDS_PER_PAGE, nrec - pg_idx * RECORDS_PER_PAGE)
+                slots = prange.live_slots(pg_idx, n)
+                if not slots:
+                    continue
+                rids = prange.read_column(False, pg_idx, RID_COLUMN, n)
+                live = [sl for sl in slots if rids[sl] in pdir]
+                if not live:
+                    continue
+                vals = [prange.read_column(False, pg_idx, NUM_META_COLS + c, n) for c in cols]
+                inds = prange.read_column(False, pg_idx, INDIRECTION_COLUMN, n)
+                tps_v = prange.tps.get(pg_idx, 0)
+                by_tail = {}
+                for sl in live:
+                    ind = inds[sl]
+                    if ind == NULL_RID or ind <= tps_v:
+                        continue
+                    tl = pdir.get(ind)
+                    if tl is None:
+                        continue
+                    ti, _, tpg, tslot = tl
+                    by_tail.setdefault((ti, tpg), []).append((sl, tslot))
+                for (ti, tpg), pairs in by_tail.items():
+                    tp = self.page_ranges[ti]
+                    tn = max(ts for _, ts in pairs) + 1
+                    for j in range(len(cols)):
+                        tvals = tp.read_column(True, tpg, NUM_META_COLS + cols[j], tn)
+                        cv = vals[j]
+                        for sl, tslot in pairs:
+                            cv[sl] = tvals[tslot]
+                yield [rids[sl] for sl in live], [[cv[sl] for sl in live] for cv in vals]
+
+    """
+    #Yields base rids whose column passes check, built on the columnar scan above
+    :param column: int     #user column number
+    :param check: function     #takes a value and returns True/False
+    """
+    def scan_rids(self, column, check):
+        for rids, vals in self.scan_columns([column]):
+            cv = vals[0]
+            for i in range(len(rids)):
+                if check(cv[i]):
+                    yield rids[i]
+
+    """
+    #Same as scan_rids for an equality test, pages that dont hold the value get skipped
+    #with a single C level membership test
+    :param column: int     #user column number
+    :param value: int     #value we want
+    """
+    def scan_eq(self, column, value):
+        for rids, vals in self.scan_columns([column]):
+            cv = vals[0]
+            if value not in cv:
+                continue
+            for i in range(len(rids)):
+                if cv[i] == value:
+                    yield rids[i]
+
+    """
+    #Copies a record's original values into a tail record before something overwrites its
+    #base record for the first time, older versions and as-of reads need them after that
+    #the copy carries the insert timestamp and hangs off the oldest tail so its the oldest
+    #entry of the version chain, updates never pay for it, only the first merge that
+    #touches the record does, call holding the record latch
+    :param base_rid: int     #base rid of the record
+    :param rng_ix: int     #its page range
+    :param pgnum: int     #base page
+    :param sl: int     #base slot
+    """
+    def save_original(self, base_rid, rng_ix, pgnum, sl):
+        prange = self.page_ranges[rng_ix]
+        schema = prange.get_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN)
+        if schema & ORIGINAL_SAVED:
+            return
+        pdir = self.page_directory
+        oldest = None
+        curr = prange.get_base_val(pgnum, sl, INDIRECTION_COLUMN)
+        while curr != NULL_RID:
+            oldest = pdir.get(curr)
+            if oldest is None:
+                return
+            ti, _, tpg, tslot = oldest
+            curr = self.page_ranges[ti].get_tail_val(tpg, tslot, INDIRECTION_COLUMN)
+        if oldest is None:
+            return
+        copy_rid = self.new_rid()
+        row = [0] * self.total_cols
+        row[INDIRECTION_COLUMN] = NULL_RID
+        row[RID_COLUMN] = copy_rid
+        row[TIMESTAMP_COLUMN] = prange.get_base_val(pgnum, sl, TIMESTAMP_COLUMN)
+        row[SCHEMA_ENCODING_COLUMN] = 0
+        vals = prange.get_base_vals(pgnum, sl, NUM_META_COLS, self.num_columns)
+        for i in range(self.num_columns):
+            row[NUM_META_COLS + i] = vals[i]
+        cpg, cslot = prange.add_tail_record(row)
+        pdir[copy_rid] = (rng_ix, True, cpg, cslot)
+        ti, _, tpg, tslot = oldest
+        self.page_ranges[ti].set_tail_val(tpg, tslot, INDIRECTION_COLUMN, copy_rid)
+        prange.set_base_val(pgnum, sl, SCHEMA_ENCODING_COLUMN, schema | ORIGINAL_SAVED)
+        ent = self.versions.get(base_rid)
+        if ent is not None:
+            ent[0].insert(0, row[TIMESTAMP_COLUMN])
+            ent[1].insert(0, copy_rid)
+
     """
     #Takes updates stored in tail pages and applies the latest values back into base pages
+    #merge only moves the latest values around, so column summaries and the row cache dont need touching
+    #a record's original values get saved in a tail record before its base is first overwritten
     :param range_idx: 
     def merge(self, range_idx): int     #index of a pagerange inside self.page_ranges
     """
@@ -204,25 +620,35 @@ class Table:
             n_user_cols = total_cols - NUM_META_COLS
             nrec = prange.num_base_records
             npages = (nrec + RECORDS_PER_PAGE - 1) // RECORDS_PER_PAGE
+            # tails made after we start are left for the next merge, otherwise the TPS
+            # could end up covering an update we never copied in
+            limit = self.next_rid
             for pg_idx in range(npages):
-                mt = prange.tps.get(pg_idx, 0)
+                old_tps = prange.tps.get(pg_idx, 0)
+                mt = old_tps
                 nslots = min(RECORDS_PER_PAGE, nrec - pg_idx * RECORDS_PER_PAGE)
-                for sl in range(nslots):
-                    rid = prange.get_base_val(pg_idx, sl, RID_COLUMN)
-                    if rid not in pdir:
-                        continue
-                    ind = prange.get_base_val(pg_idx, sl, INDIRECTION_COLUMN)
-                    if ind == NULL_RID or ind <= mt:
-                        continue
-                    if ind not in pdir:
-                        continue
-                    tl = pdir[ind]
-                    ti, _, tpg, tslot = tl
-                    tp = pranges[ti]
-                    vls = tp.get_tail_vals(tpg, tslot, NUM_META_COLS, n_user_cols)
-                    for i in range(n_user_cols):
-                        prange.set_base_val(pg_idx, sl, NUM_META_COLS + i, vls[i])
-                    mt = max(mt, ind)
+                # the copies of original rows are new records, a checkpoint has to see each
+                # one together with the tail that points at it
+                with self.gate if self.gate is not None else nullcontext():
+                    for sl in prange.live_slots(pg_idx, nslots):
+                        rid = prange.get_base_val(pg_idx, sl, RID_COLUMN)
+                        if rid not in pdir:
+                            continue
+                        # the record latch keeps a rollback from undoing the tail while we copy it
+                        with self.latch_for(rid):
+                            ind = prange.get_base_val(pg_idx, sl, INDIRECTION_COLUMN)
+                            if ind == NULL_RID or ind <= old_tps or ind >= limit:
+                                continue
+                            tl = pdir.get(ind)
+                            if tl is None:
+                                continue
+                            self.save_original(rid, range_idx, pg_idx, sl)
+                            ti, _, tpg, tslot = tl
+                            tp = pranges[ti]
+                            vls = tp.get_tail_vals(tpg, tslot, NUM_META_COLS, n_user_cols)
+                            for i in range(n_user_cols):
+                                prange.set_base_val(pg_idx, sl, NUM_META_COLS + i, vls[i])
+                        mt = max(mt, ind)
                 prange.tps[pg_idx] = mt
         except Exception:
             pass
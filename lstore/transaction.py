@@ -1,27 +1,445 @@
+import itertools
+from contextlib import nullcontext
 from lstore.table import Table, Record
 from lstore.index import Index
+from lstore import clock
+from lstore.undo import UndoLog
+from lstore.wal import capture
+from lstore.config import INDIRECTION_COLUMN
 
+# transaction ids double as wait-die timestamps, smaller is older
+_txn_ids = itertools.count(1)
+
+# queries that find their records through (search key, column)
+POINT_READS = ('select', 'select_iter', 'select_version', 'select_as_of')
+# queries that rewrite the one record with primary key args[0]
+KEY_WRITES = ('update', 'delete', 'increment', 'apply', 'add')
+# multi record writes, these just take the whole table
+TABLE_WRITES = ('delete_many', 'delete_range', 'delete_where', 'update_many')
+# queries snapshot and optimistic transactions buffer until commit
+BUFFERED_WRITES = ('insert',) + KEY_WRITES
+# concurrency control modes: strict two phase locking, snapshot isolation, optimistic
+MODES = ('2pl', 'si', 'occ')
+
+# indirection of a base record, our version number for OCC, None once its deleted
+def _indirection(table, rid):
+    locn = table.page_directory.get(rid)
+    if locn is None:
+        return None
+    rng_ix, _, pgnum, sl = locn
+    return table.page_ranges[rng_ix].get_base_val(pgnum, sl, INDIRECTION_COLUMN)
+
+"""
+# A list of queries that commit or abort together
+# in '2pl' mode queries run right away under strict two phase locks
+# in 'si' mode reads see the snapshot as of the start timestamp and writes are buffered,
+# commit checks nobody else committed a newer version of the written records since we
+# started (first committer wins) and installs everything with one commit timestamp
+# in 'occ' mode writes are buffered too but reads see the latest data, each record read
+# remembers its indirection and commit validates those are unchanged before installing,
+# no locks at all so it wins when transactions rarely touch the same keys
+:param mode: str     # '2pl', 'si' or 'occ'
+"""
 class Transaction:
-    def __init__(self):
+    def __init__(self, mode='2pl'):
+        if mode not in MODES:
+            raise ValueError('unknown transaction mode %r' % (mode,))
+        self.mode = mode
         self.queries = []
-        pass
+        self.ts = next(_txn_ids)
+        self.locks = {}     # resource -> mode, filled in by the lock manager
+        self.start_ts = None
+        self.writes = {}    # table name -> {primary key: row after our writes, None if deleted}
+        self.snap = {}      # table name -> {primary key: row in our snapshot, None if absent}
+        self.tables = {}    # table name -> Query used to read and install
+        self.reads = {}     # (table name, base rid) -> indirection when we first read it
+        self.absent = set() # (table name, primary key) we saw missing
+        self.undo = UndoLog()   # how to take back the writes made so far
+        self.redo = []          # logical ops for the write ahead log, written at commit
+        self.logged = None      # (wal, lsn) of our commit record
+        self.unlocked = False   # running for the batch scheduler, writes go straight in
+        self.retryable = False  # whether the last abort is worth running again
 
     # add a query to this transactoin
     def add_query(self, query, table, *args):
-        self.queries.append((query, args))
+        self.queries.append((query, table, args))
 
     # retruns True if commit, False on abort
     def run(self):
-        for query, args in self.queries:
-            res = query(*args)
+        with self._writing():
+            return self._run()
+
+    # a transaction that writes holds the checkpoint gate from its first query to its commit
+    # record, so a checkpoint never sees half of it or an abort it wont see undone
+    def _writing(self):
+        for query, table, _ in self.queries:
+            if table.gate is not None and getattr(query, '__name__', '') in BUFFERED_WRITES + TABLE_WRITES:
+                return table.gate
+        return nullcontext()
+
+    """
+    # Runs the queries in order without taking any locks, for the batch scheduler which has
+    # already made sure nothing running at the same time touches our keys, so the only way
+    # this aborts is a query failing (the writes before it get rolled back)
+    """
+    def run_unlocked(self):
+        with self._writing():
+            return self._run(lock=False)
+
+    def _run(self, lock=True):
+        self.unlocked = not lock
+        if lock and self.mode != '2pl':
+            return self._run_buffered()
+        self.undo.claim = self._lock_inserted if lock else None
+        for query, table, args in self.queries:
+            if lock and not self._lock(query, table, args):
+                return self.abort(retryable=True)
+            with self.undo, capture(self.redo):
+                res = query(*args)
+            if res == False:
+                return self.abort()
+        return self.commit()
+
+    """
+    # Takes the strict 2PL locks a query needs before it runs, False means abort
+    # point queries lock the records they will touch (intention lock on the table first),
+    # anything that names a primary key (inserts, key writes, selects on the key column)
+    # also locks that key so one resource guards it whether the record exists or not,
+    # anything else that reads many records locks the whole table shared and a bulk write
+    # locks it exclusive
+    :param query: function     # bound Query method
+    :param table: Table        # the table it runs against
+    :param args: tuple         # its arguments
+    """
+    def _lock(self, query, table, args):
+        lm = table.lock_manager
+        tres = ('table', table.name)
+        name = getattr(query, '__name__', '')
+        if name in POINT_READS:
+            key, col = args[0], args[1]
+            if table.index.indices[col] is None:
+                return lm.acquire(self, tres, 'S')
+            if not lm.acquire(self, tres, 'IS'):
+                return False
+            if col == table.key and not lm.acquire(self, ('key', table.name, key), 'S'):
+                return False
+            for rid in table.index.locate(col, key):
+                if not lm.acquire(self, ('rid', table.name, rid), 'S'):
+                    return False
+            return True
+        if name in KEY_WRITES:
+            if not lm.acquire(self, tres, 'IX'):
+                return False
+            # the key lock is what a delete and a later insert of the same key both take,
+            # the rid locks keep readers that came in through another column out
+            if not lm.acquire(self, ('key', table.name, args[0]), 'X'):
+                return False
+            for rid in table.index.locate(table.key, args[0]):
+                if not lm.acquire(self, ('rid', table.name, rid), 'X'):
+                    return False
+            return True
+        if name == 'insert':
+            if not lm.acquire(self, tres, 'IX'):
+                return False
+            return lm.acquire(self, ('key', table.name, args[table.key]), 'X')
+        if name in TABLE_WRITES:
+            return lm.acquire(self, tres, 'X')
+        return lm.acquire(self, tres, 'S')
+
+    # locks the rid an insert is about to use, called by the insert before the record shows
+    # up in any index so nobody can reach it before we hold it
+    def _lock_inserted(self, table, rid):
+        return table.lock_manager.acquire(self, ('rid', table.name, rid), 'X')
+
+    # drops the locks of whatever table managers we touched
+    def _release(self):
+        if not self.locks:
+            return
+        mgrs = []
+        for _, table, _ in self.queries:
+            if table.lock_manager not in mgrs:
+                mgrs.append(table.lock_manager)
+        for lm in mgrs:
+            lm.release_all(self)
+        self.locks = {}
+
+    """
+    # Runs the queries with writes buffered, then validates and installs at commit
+    # 'si' reads the snapshot as of the start timestamp, 'occ' reads the latest committed
+    # data and remembers which version of every record it saw
+    """
+    def _run_buffered(self):
+        self.start_ts = clock.snapshot() if self.mode == 'si' else None
+        self.writes = {}
+        self.snap = {}
+        self.tables = {}
+        self.reads = {}
+        self.absent = set()
+        for query, table, args in self.queries:
+            q = query.__self__
+            self.tables[table.name] = q
+            name = query.__name__
+            if name in BUFFERED_WRITES:
+                res = self._buffer_write(q, name, args)
+            elif name == 'select':
+                res = self._buffered_select(q, *args[:3])
+            elif name == 'sum':
+                res = self._buffered_sum(q, *args[:3])
+            else:
+                # anything else reads the latest committed data
+                res = query(*args)
             if res == False:
                 return self.abort()
         return self.commit()
 
-    def abort(self):
-        # TODO: roll-back and wahtever else
+    # row of a primary key as this transaction sees it, None if it doesnt exist
+    def _row(self, q, pk):
+        tw = self.writes.get(q.table.name)
+        if tw is not None and pk in tw:
+            return tw[pk]
+        return self._read_row(q, pk)
+
+    # row of a primary key before our own writes, read once and kept in self.snap
+    def _read_row(self, q, pk):
+        ts = self.snap.setdefault(q.table.name, {})
+        if pk not in ts:
+            tbl = q.table
+            if self.mode == 'si':
+                res = q.select_as_of(pk, tbl.key, [1] * tbl.num_columns, self.start_ts)
+                ts[pk] = list(res[0].columns) if res else None
+            else:
+                rids = tbl.index.locate(tbl.key, pk)
+                row = self._read_tracked(q, rids[0]) if rids else None
+                if row is None:
+                    self.absent.add((tbl.name, pk))
+                ts[pk] = row
+        return ts[pk]
+
+    """
+    # OCC read: notes the record's indirection before reading it, so a write that lands in
+    # between shows up at validation as a changed version
+    :param q: Query        # query object of the table
+    :param rid: int        # base rid of the record
+    """
+    def _read_tracked(self, q, rid):
+        ind = _indirection(q.table, rid)
+        if ind is None:
+            return None
+        self.reads.setdefault((q.table.name, rid), ind)
+        try:
+            return q._get_record_values(rid)
+        except KeyError:
+            return None
+
+    """
+    # Buffers one write, returns False where the query itself would have failed
+    :param q: Query        # query object of the table
+    :param name: str       # which write query
+    :param args: tuple     # its arguments
+    """
+    def _buffer_write(self, q, name, args):
+        tbl = q.table
+        if name == 'insert':
+            if len(args) != tbl.num_columns or None in args:
+                return False
+            pk = args[tbl.key]
+            if self._row(q, pk) is not None:
+                return False
+            new = list(args)
+        else:
+            pk = args[0]
+            row = self._row(q, pk)
+            if row is None:
+                return False
+            new = list(row)
+            if name == 'delete':
+                new = None
+            elif name == 'update':
+                cols = args[1:]
+                if cols[tbl.key] is not None and cols[tbl.key] != pk:
+                    return False
+                for i, v in enumerate(cols):
+                    if v is not None:
+                        new[i] = v
+            elif name == 'increment':
+                new[args[1]] = new[args[1]] + 1
+            elif name == 'add':
+                new[args[1]] = new[args[1]] + args[2]
+            else:
+                for i, fn in args[1].items():
+                    new[i] = fn(new[i])
+                if new[tbl.key] != pk:
+                    return False
+        self._read_row(q, pk)
+        self.writes.setdefault(tbl.name, {})[pk] = new
+        return True
+
+    """
+    # Select with our own writes laid on top, records are found through the current index
+    :param q: Query                  # query object of the table
+    :param search_key: int           # value we are searching for
+    :param search_key_index: int     # which column to search in
+    :param projected_columns_index: list  # which columns to return
+    """
+    def _buffered_select(self, q, search_key, search_key_index, projected_columns_index):
+        tbl = q.table
+        tw = self.writes.get(tbl.name, {})
+        if self.mode == 'si':
+            res = q.select_as_of(search_key, search_key_index, [1] * tbl.num_columns, self.start_ts)
+            if res is False:
+                return False
+            rows = [(r.rid, r.columns) for r in res]
+        else:
+            rows = []
+            for rid in q._locate(search_key_index, search_key):
+                vls = self._read_tracked(q, rid)
+                if vls is not None:
+                    rows.append((rid, vls))
+            if not rows and search_key_index == tbl.key:
+                self.absent.add((tbl.name, search_key))
+        rows = [r for r in rows if r[1][tbl.key] not in tw]
+        for pk, row in tw.items():
+            if row is not None and row[search_key_index] == search_key:
+                rows.append((None, row))
+        out = []
+        for rid, row in rows:
+            cols = [row[i] if projected_columns_index[i] else None for i in range(tbl.num_columns)]
+            out.append(Record(rid, search_key, cols))
+        return out
+
+    """
+    # Sum corrected for the keys we wrote in the range
+    :param q: Query                      # query object of the table
+    :param start_range: int              # lower bound of primary key range
+    :param end_range: int                # upper bound of primary key range
+    :param aggregate_column_index: int   # the column index to sum
+    """
+    def _buffered_sum(self, q, start_range, end_range, aggregate_column_index):
+        tbl = q.table
+        if self.mode == 'si':
+            tot = q.sum_as_of(start_range, end_range, aggregate_column_index, self.start_ts)
+        else:
+            tot = False
+            for rid in q._locate_range(start_range, end_range, tbl.key):
+                vls = self._read_tracked(q, rid)
+                if vls is not None:
+                    tot = (tot or 0) + vls[aggregate_column_index]
+        found = tot is not False
+        tot = tot or 0
+        snap = self.snap.get(tbl.name, {})
+        for pk, row in self.writes.get(tbl.name, {}).items():
+            if pk < start_range or pk > end_range:
+                continue
+            old = snap.get(pk)
+            if old is not None:
+                tot = tot - old[aggregate_column_index]
+            if row is not None:
+                tot = tot + row[aggregate_column_index]
+                found = True
+        if not found:
+            return False
+        return tot
+
+    """
+    # Checks nothing we depend on changed, called holding the commit lock
+    # 'si' is first committer wins: every written key must still be at the version our
+    # snapshot saw, 'occ' checks every record it read is at the version it read and every
+    # key it found missing is still missing
+    """
+    def _validate(self):
+        if self.mode == 'si':
+            for tn, tw in self.writes.items():
+                tbl = self.tables[tn].table
+                snap = self.snap[tn]
+                for pk in tw:
+                    rids = tbl.index.locate(tbl.key, pk)
+                    if snap[pk] is None:
+                        if rids:
+                            return False
+                    elif not rids or tbl.last_modified(rids[0]) > self.start_ts:
+                        return False
+            return True
+        for (tn, rid), ind in self.reads.items():
+            if _indirection(self.tables[tn].table, rid) != ind:
+                return False
+        for tn, pk in self.absent:
+            tbl = self.tables[tn].table
+            if tbl.index.locate(tbl.key, pk):
+                return False
+        return True
+
+    """
+    # Validation and install happen in one critical section, the writes go in stamped with
+    # one commit timestamp so a snapshot sees all of them or none
+    """
+    def _commit_buffered(self):
+        if self.mode == 'si' and not self.writes:
+            return True
+        with clock.commit_lock:
+            if not self._validate():
+                return False
+            if not self.writes:
+                return True
+            with clock.pinned(clock.now()), self.undo, capture(self.redo):
+                for tn, tw in self.writes.items():
+                    q = self.tables[tn]
+                    snap = self.snap[tn]
+                    for pk, row in tw.items():
+                        old = snap[pk]
+                        ok = True
+                        if row is None:
+                            if old is not None:
+                                ok = q.delete(pk)
+                        elif old is None:
+                            ok = q.insert(*row)
+                        elif row != old:
+                            ok = q.update(pk, *[v if v != o else None for v, o in zip(row, old)])
+                        if not ok:
+                            # somebody outside the transaction system got in the way
+                            self.undo.rollback()
+                            return False
+            self._log_commit()
+        return True
+
+    # hands our ops to the write ahead log as one record, before any lock is let go so the
+    # log order agrees with the order conflicting transactions committed in
+    def _log_commit(self):
+        if not self.redo:
+            return
+        for _, table, _ in self.queries:
+            if table.wal is not None:
+                self.logged = (table.wal, table.wal.append(self.redo))
+                return
+
+    """
+    # Takes back whatever we wrote (newest first), only then lets go of the locks
+    :param retryable: bool   # True when another transaction got in the way (lock denied or
+                             # validation failed), False when a query failed by itself and
+                             # would fail the same way on a rerun
+    """
+    def abort(self, retryable=False):
+        self.retryable = retryable
+        self.undo.rollback()
+        self._release()
+        self.writes = {}
+        self.redo = []
         return False
 
+    # the commit record is waited for after the locks are gone, others neednt sit out our fsync
     def commit(self):
-        # TODO: commit to db
+        self.logged = None
+        if self.mode != '2pl' and not self.unlocked:
+            if not self._commit_buffered():
+                return self.abort(retryable=True)
+        else:
+            self._log_commit()
+        self.undo.clear()
+        self._release()
+        self.writes = {}
+        self.redo = []
+        if self.logged is not None:
+            wal, lsn = self.logged
+            self.logged = None
+            if wal.sync_commit:
+                wal.wait(lsn)
         return True
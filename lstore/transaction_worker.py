@@ -1,25 +1,87 @@
+import threading
+import random
+from time import perf_counter, sleep
 from lstore.table import Table, Record
 from lstore.index import Index
+from lstore.config import TXN_MAX_RETRIES, TXN_BACKOFF_BASE, TXN_BACKOFF_MAX
 
 class TransactionWorker:
-    def __init__(self, transactions = []):
+    """
+    # Runs its transactions on its own thread, aborted ones get retried with backoff
+    :param transactions: list   # transactions to start with
+    :param max_retries: int     # reruns per transaction before it counts as aborted for good
+    :param mode: str            # if set, runs every transaction in this mode ('2pl', 'si', 'occ')
+    """
+    def __init__(self, transactions = None, max_retries = TXN_MAX_RETRIES, mode = None):
         self.stats = []
-        self.transactions = transactions
+        self.transactions = transactions if transactions is not None else []
         self.result = 0
-        pass
+        self.max_retries = max_retries
+        self.mode = mode
+        self.commits = 0
+        self.aborts = 0
+        self.retries = 0
+        self.latencies = []
+        self.thread = None
 
     def add_transaction(self, t):
         self.transactions.append(t)
 
+    # create thread and call __run
     def run(self):
-        pass
-        # create thread and call __run
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
 
+    # waits for the worker thread to finish
     def join(self):
-        pass
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    """
+    # Per worker numbers: commits, aborts, retries and latency per transaction in seconds
+    # latency covers every attempt including the backoff sleeps
+    """
+    def report(self):
+        n = len(self.latencies)
+        lat = sorted(self.latencies)
+        return {
+            'commits': self.commits,
+            'aborts': self.aborts,
+            'retries': self.retries,
+            'avg_latency': sum(lat) / n if n else 0.0,
+            'p99_latency': lat[min(n - 1, int(n * 0.99))] if n else 0.0,
+            'max_latency': lat[-1] if n else 0.0,
+        }
 
     def __run(self):
         for txn in self.transactions:
-            self.stats.append(txn.run())
+            self.stats.append(self._run_one(txn))
         # num that commited
         self.result = len(list(filter(lambda x: x, self.stats)))
+
+    """
+    # Runs one transaction, on abort sleeps a jittered exponential backoff and tries again
+    # only aborts caused by other transactions get retried, a query that failed by itself
+    # (missing key, duplicate insert) would just fail again
+    :param txn: Transaction     # the transaction to run
+    """
+    def _run_one(self, txn):
+        if self.mode is not None:
+            txn.mode = self.mode
+        start = perf_counter()
+        delay = TXN_BACKOFF_BASE
+        ok = txn.run()
+        tries = 0
+        while not ok and txn.retryable and tries < self.max_retries:
+            tries = tries + 1
+            self.retries = self.retries + 1
+            sleep(random.uniform(0, delay))
+            delay = min(delay * 2, TXN_BACKOFF_MAX)
+            ok = txn.run()
+        self.latencies.append(perf_counter() - start)
+        if ok:
+            self.commits = self.commits + 1
+        else:
+            self.aborts = self.aborts + 1
+        return ok
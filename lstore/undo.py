@@ -0,0 +1,51 @@
+import threading
+from lstore.wal import capture
+
+"""
+# in memory undo log of one transaction
+# while a log is active on a thread (with log: ...) every insert/update/delete Query does
+# on that thread pushes the function that takes it back, rollback runs them newest first
+# so aborting costs as much as the writes did, no matter how big the table is
+"""
+_local = threading.local()
+
+
+# the log active on this thread, None outside a transaction
+def current():
+    return getattr(_local, 'log', None)
+
+
+class UndoLog:
+    def __init__(self):
+        self.entries = []   # (function, args), oldest first
+        self.claim = None   # claim(table, rid) runs before an insert makes its record visible,
+                            # False stops the insert, 2PL transactions lock the new rid there
+
+    def __enter__(self):
+        _local.log = self
+        return self
+
+    def __exit__(self, *exc):
+        _local.log = None
+        return False
+
+    # remembers how to take back one write
+    def push(self, fn, *args):
+        self.entries.append((fn, args))
+
+    # takes back everything in reverse order, the undo functions themselves dont get logged
+    # here or in the write ahead log (whatever they would log goes into a list thats dropped)
+    def rollback(self):
+        prev = current()
+        _local.log = None
+        try:
+            with capture([]):
+                while self.entries:
+                    fn, args = self.entries.pop()
+                    fn(*args)
+        finally:
+            _local.log = prev
+
+    # forgets everything, the writes are staying
+    def clear(self):
+        self.entries = []
@@ -0,0 +1,211 @@
+import os
+import json
+import threading
+from time import sleep
+from lstore.config import WAL_GROUP_COMMIT_MS, WAL_SYNC_COMMIT
+
+"""
+# write ahead log of logical operations, one JSON line per record: [lsn, [op, ...]]
+# an op is [table, kind, args...] with kind one of insert (full row), update (primary key
+# and the absolute new values, None where unchanged), delete (primary key), create_table and
+# drop_table, so replaying a record twice or onto a newer page gives the same result
+# a transaction becomes one record at commit, a query outside any transaction is its own
+# record and doesnt wait for the disk
+# group commit: a flusher thread waits the group commit window after the first pending
+# record so commits arriving meanwhile share one write + fsync, committers that want
+# durability block until their lsn is flushed
+"""
+_local = threading.local()
+
+
+"""
+# Collects the ops logged on this thread into ops instead of writing them one by one,
+# used by transactions so they reach the log as a single record at commit
+:param ops: list     # where the ops go
+"""
+class capture:
+    def __init__(self, ops):
+        self.ops = ops
+
+    def __enter__(self):
+        self.prev = getattr(_local, 'ops', None)
+        _local.ops = self.ops
+        return self.ops
+
+    def __exit__(self, *exc):
+        _local.ops = self.prev
+        return False
+
+
+class WriteAheadLog:
+    """
+    # the log is a run of segment files path.1, path.2, ... a checkpoint starts a new one
+    # and deletes the older ones once it is on disk, so cutting the log back never copies
+    # records or holds up the flusher
+    :param path: str              # the log file, segments get a .N suffix
+    :param group_commit_ms: int   # how long the flusher waits to gather a group, 0 flushes right away
+    :param sync_commit: bool      # if False commits dont wait for the fsync (can lose one window)
+    """
+    def __init__(self, path, group_commit_ms=WAL_GROUP_COMMIT_MS, sync_commit=WAL_SYNC_COMMIT):
+        self.path = path
+        self.window = group_commit_ms / 1000.0
+        self.sync_commit = sync_commit
+        self.next_lsn = 1
+        self.flushed_lsn = 0
+        self.pending = []       # (lsn, ops) not written yet
+        self.cond = threading.Condition(threading.Lock())
+        self._io = threading.Lock()     # held while the file is written or swapped
+        self.seq = 1            # segment new records go to
+        self.file = None
+        self.thread = None
+        self.running = False
+        self.fsyncs = 0
+        self.records = 0
+
+    # file name of one segment
+    def _segment(self, seq):
+        return '%s.%d' % (self.path, seq)
+
+    # sequence numbers of the segments on disk, oldest first
+    def _segments(self):
+        d, base = os.path.split(self.path)
+        seqs = []
+        for fn in os.listdir(d or '.'):
+            if fn.startswith(base + '.') and fn[len(base) + 1:].isdigit():
+                seqs.append(int(fn[len(base) + 1:]))
+        return sorted(seqs)
+
+    """
+    # Reads back every complete record in the segments, a torn last line from a crash is
+    # cut off so new records dont get glued onto it, also moves next_lsn past what it found
+    """
+    def read(self):
+        recs = []
+        seqs = self._segments()
+        for seq in seqs:
+            pth = self._segment(seq)
+            got, good = self._scan(pth)
+            recs.extend(got)
+            if good < os.path.getsize(pth):
+                os.truncate(pth, good)
+        if seqs:
+            self.seq = seqs[-1]
+        if recs:
+            self.next_lsn = max(self.next_lsn, recs[-1][0] + 1)
+            self.flushed_lsn = recs[-1][0]
+        return recs
+
+    # parses one segment up to the first incomplete line, returns (records, bytes they take)
+    def _scan(self, pth):
+        recs = []
+        good = 0
+        f = open(pth, 'rb')
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                lsn, ops = json.loads(line)
+            except ValueError:
+                break
+            recs.append((lsn, ops))
+            good = good + len(line)
+        f.close()
+        return recs, good
+
+    # opens the current segment for appending and starts the flusher, lsns continue after
+    # the checkpoint even when the log was cut back to nothing
+    def start(self, checkpoint_lsn=0):
+        if self.next_lsn <= checkpoint_lsn:
+            self.next_lsn = checkpoint_lsn + 1
+            self.flushed_lsn = checkpoint_lsn
+        self.file = open(self._segment(self.seq), 'a')
+        self.running = True
+        self.thread = threading.Thread(target=self._flusher, daemon=True)
+        self.thread.start()
+
+    # queues one record, returns its lsn
+    def append(self, ops):
+        with self.cond:
+            lsn = self.next_lsn
+            self.next_lsn = lsn + 1
+            self.pending.append((lsn, ops))
+            self.cond.notify_all()
+        return lsn
+
+    # logs one op of a table, into the current transaction if there is one
+    def log(self, table, op):
+        ops = getattr(_local, 'ops', None)
+        if ops is not None:
+            ops.append([table] + op)
+        else:
+            self.append([[table] + op])
+
+    # blocks until everything up to lsn is on disk
+    def wait(self, lsn):
+        with self.cond:
+            while self.flushed_lsn < lsn and self.running:
+                self.cond.wait()
+
+    # forces out everything queued so far, returns the last lsn handed out
+    def flush(self):
+        lsn = self.next_lsn - 1
+        self.wait(lsn)
+        return lsn
+
+    def _flusher(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.running:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+            if self.window:
+                sleep(self.window)
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+            with self._io:
+                self.file.write(''.join(json.dumps([lsn, ops], separators=(',', ':')) + '\n' for lsn, ops in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            with self.cond:
+                self.fsyncs = self.fsyncs + 1
+                self.records = self.records + len(batch)
+                self.flushed_lsn = batch[-1][0]
+                self.cond.notify_all()
+
+    # starts a new segment, records queued from now on go there, returns its number
+    def rotate(self):
+        with self._io:
+            self.file.close()
+            self.seq = self.seq + 1
+            self.file = open(self._segment(self.seq), 'a')
+            return self.seq
+
+    """
+    # Deletes the segments older than seq, a checkpoint calls this once it is on disk since
+    # everything logged before it started the segment is then in the pages
+    :param seq: int     # the segment the checkpoint started
+    """
+    def drop_before(self, seq):
+        for old in self._segments():
+            if old < seq:
+                os.remove(self._segment(old))
+
+    # flushes what is left and stops the flusher
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+        self.file = None
+
+    # numbers for tuning the group commit window
+    def stats(self):
+        return {'records': self.records, 'fsyncs': self.fsyncs,
+                'records_per_fsync': self.records / self.fsyncs if self.fsyncs else 0.0}
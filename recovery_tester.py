@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+from random import randint, sample, seed
+
+from lstore.db import Database
+from lstore.query import Query
+from lstore.transaction import Transaction
+
+# crash and reopen: a child process writes through transactions, checkpoints halfway and
+# then dies without close(), the parent reopens the database and compares every record,
+# the secondary index and a range sum with what the child committed
+
+path = './RECOVERY'
+expected_file = './RECOVERY_expected.json'
+number_of_records = 2000
+number_of_transactions = 400
+
+
+def crash():
+    db = Database()
+    db.open(path)
+    grades_table = db.create_table('Grades', 5, 0)
+    query = Query(grades_table)
+    grades_table.index.create_index(2)
+    records = {}
+    seed(3562901)
+
+    def run(*queries):
+        t = Transaction()
+        for q in queries:
+            t.add_query(q[0], grades_table, *q[1:])
+        return t.run()
+
+    for i in range(number_of_records):
+        key = 92106429 + i
+        records[key] = [key, randint(0, 20), randint(0, 20), randint(0, 20), randint(0, 20)]
+        run((query.insert, *records[key]))
+    keys = sorted(records)
+
+    for i in range(number_of_transactions):
+        if i == number_of_transactions // 2:
+            # half the work lands in the checkpoint, the other half only in the log
+            db.checkpoint()
+        k1, k2 = sample(keys, 2)
+        if records[k1] is None or records[k2] is None:
+            continue
+        op = i % 5
+        if op == 0:
+            # aborts on the update of a key that isnt there, nothing of it may come back
+            run((query.update, k1, None, 99, None, None, None), (query.update, -1, None, 1, None, None, None))
+        elif op == 1:
+            run((query.delete, k1))
+            records[k1] = None
+        elif op == 2:
+            cols = [None, randint(0, 20), randint(0, 20), None, None]
+            if run((query.update, k1, *cols), (query.increment, k2, 4)):
+                records[k1][1] = cols[1]
+                records[k1][2] = cols[2]
+                records[k2][4] = records[k2][4] + 1
+        elif op == 3:
+            new_key = 92106429 + number_of_records + i
+            records[new_key] = [new_key, i, i % 21, 0, 0]
+            run((query.insert, *records[new_key]))
+        else:
+            run((query.update, k1, None, None, None, randint(0, 20), None))
+            records[k1] = query.select(k1, 0, [1, 1, 1, 1, 1])[0].columns
+    # a bulk delete inside a transaction
+    first = keys[100]
+    last = keys[119]
+    run((query.delete_range, first, last))
+    for key in keys[100:120]:
+        records[key] = None
+
+    with open(expected_file, 'w') as fp:
+        json.dump({str(k): v for k, v in records.items()}, fp)
+    # no close(): whatever isnt in the log or the checkpoint is lost
+    os._exit(0)
+
+
+if len(sys.argv) > 1 and sys.argv[1] == 'crash':
+    crash()
+
+shutil.rmtree(path, ignore_errors=True)
+if os.path.exists(expected_file):
+    os.remove(expected_file)
+subprocess.run([sys.executable, os.path.abspath(__file__), 'crash'], check=True)
+print("Crash finished")
+
+with open(expected_file) as fp:
+    records = {int(k): v for k, v in json.load(fp).items()}
+os.remove(expected_file)
+
+db = Database()
+db.open(path)
+grades_table = db.get_table('Grades')
+query = Query(grades_table)
+
+score = len(records)
+for key, correct in records.items():
+    result = query.select(key, 0, [1, 1, 1, 1, 1])
+    if correct is None:
+        if result:
+            print('deleted record came back', key, ':', result[0].columns)
+            score -= 1
+    elif not result or result[0].columns != correct:
+        print('select error on', key, ':', result[0].columns if result else None, ', correct:', correct)
+        score -= 1
+print("Select finished")
+
+live = [v for v in records.values() if v is not None]
+for value in range(21):
+    correct = sorted(v for v in live if v[2] == value)
+    result = sorted(r.columns for r in query.select(value, 2, [1, 1, 1, 1, 1]))
+    if result != correct:
+        print('index error on value', value, ':', len(result), 'records, correct:', len(correct))
+        score -= 1
+print("Index finished")
+
+keys = sorted(records)
+correct = sum(v[3] for v in live)
+result = query.sum(keys[0], keys[-1], 3)
+if result != correct:
+    print('sum error:', result, ', correct:', correct)
+    score -= 1
+print("Aggregate finished")
+
+print('Score', score, '/', len(records))
+db.close()
+shutil.rmtree(path, ignore_errors=True)
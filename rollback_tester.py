@@ -0,0 +1,92 @@
+from random import randint, sample, choice, seed
+
+from lstore.db import Database
+from lstore.query import Query
+from lstore.transaction import Transaction
+
+# rollback: every transaction below writes a mix of inserts, updates, deletes and bulk
+# deletes and then runs a query that fails, so all of it has to be taken back
+# after each one the records, the secondary indexes, the column summary, the row cache
+# and the range sums must look exactly like before
+
+db = Database()
+grades_table = db.create_table('Grades', 5, 0)
+query = Query(grades_table)
+
+number_of_records = 1000
+number_of_transactions = 200
+
+records = {}
+seed(3562901)
+for i in range(number_of_records):
+    key = 92106429 + i
+    records[key] = [key, randint(0, 20), randint(0, 20), randint(0, 20), randint(0, 20)]
+    query.insert(*records[key])
+keys = sorted(records)
+
+grades_table.index.create_index(2)
+grades_table.index.create_index(3)
+grades_table.enable_summary(4)
+grades_table.enable_row_cache()
+# updated versions in the base pages too, rollbacks have to deal with merged records
+for key in sample(keys, 200):
+    records[key][3] = randint(0, 20)
+    query.update(key, None, None, None, records[key][3], None)
+for i in range(len(grades_table.page_ranges)):
+    grades_table.merge(i)
+
+
+def check(label):
+    errors = 0
+    for key in keys:
+        result = query.select(key, 0, [1, 1, 1, 1, 1])
+        if len(result) != 1 or result[0].columns != records[key]:
+            print(label, 'select error on', key, ':', [r.columns for r in result], ', correct:', records[key])
+            errors += 1
+    for col in (2, 3):
+        for value in range(21):
+            correct = sorted(k for k in keys if records[k][col] == value)
+            result = sorted(r.columns[0] for r in query.select(value, col, [1, 0, 0, 0, 0]))
+            if result != correct:
+                print(label, 'index error on column', col, 'value', value)
+                errors += 1
+    for col in (1, 4):
+        correct = sum(records[k][col] for k in keys)
+        result = query.sum(keys[0], keys[-1], col)
+        if result != correct:
+            print(label, 'sum error on column', col, ':', result, ', correct:', correct)
+            errors += 1
+    return errors
+
+
+score = number_of_transactions
+for i in range(number_of_transactions):
+    t = Transaction()
+    k1, k2, k3 = sample(keys, 3)
+    new_key = 92106429 + number_of_records + i
+    t.add_query(query.insert, grades_table, new_key, 1, 2, 3, 4)
+    t.add_query(query.update, grades_table, new_key, None, 5, None, None, None)
+    t.add_query(query.update, grades_table, k1, None, randint(0, 20), randint(0, 20), randint(0, 20), randint(0, 20))
+    t.add_query(query.increment, grades_table, k2, 4)
+    t.add_query(query.add, grades_table, k2, 2, 7)
+    t.add_query(query.delete, grades_table, k3)
+    start = choice(keys[:-10])
+    t.add_query(query.delete_range, grades_table, start, start + 5)
+    t.add_query(query.delete_where, grades_table, 3, lambda v: v == 20)
+    # a key that doesnt exist makes the update fail and the transaction abort
+    t.add_query(query.update, grades_table, -1, None, 1, None, None, None)
+    if t.run():
+        print('transaction', i, 'committed but should have aborted')
+        score -= 1
+        break
+    if i % 20 == 0 and check('after transaction %d:' % i):
+        score -= 1
+        break
+print("Rollback finished")
+
+if check('at the end:'):
+    score -= 1
+if grades_table.lock_manager.num_locked():
+    print('locks left behind:', grades_table.lock_manager.num_locked())
+    score -= 1
+print('Score', score, '/', number_of_transactions)
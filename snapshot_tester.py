@@ -0,0 +1,162 @@
+import threading
+from random import Random
+
+from lstore.db import Database
+from lstore.query import Query
+from lstore.transaction import Transaction
+
+# snapshot isolation: a transaction reads as of its start timestamp, so reading the same
+# records twice has to give the same answer no matter what other transactions commit in
+# between, including deleting those records (one at a time or in bulk) and reinserting
+# their keys, and a write to a record somebody deleted after we started has to abort
+
+db = Database()
+grades_table = db.create_table('Grades', 5, 0)
+query = Query(grades_table)
+grades_table.index.create_index(2)
+number_of_records = 300
+keys = list(range(1000, 1000 + number_of_records))
+for key in keys:
+    query.insert(key, key % 7, key % 5, 1, 0)
+
+score = 0
+total = 0
+
+
+def expect(label, ok):
+    global score, total
+    total += 1
+    if ok:
+        score += 1
+    else:
+        print(label, 'failed')
+
+
+# sorted column lists of a select, False stays False
+def columns_of(result):
+    if result is False:
+        return False
+    return sorted(r.columns for r in result)
+
+
+# everything one snapshot transaction can see: each record by primary key, each record by
+# a secondary column and a range sum, all as of its start timestamp
+def read_all(t):
+    rows = {}
+    for key in keys:
+        rows[key] = columns_of(query.select_as_of(key, 0, [1, 1, 1, 1, 1], t.start_ts))
+    by_column = {}
+    for value in range(5):
+        by_column[value] = columns_of(query.select_as_of(value, 2, [1, 0, 0, 0, 0], t.start_ts))
+    total_sum = query.sum_as_of(keys[0], keys[-1], 3, t.start_ts)
+    return rows, by_column, total_sum
+
+
+# a query for the middle of a snapshot transaction: reads everything, lets the others go
+# ahead and waits for them, then reads everything again
+class Probe:
+    def __init__(self, t):
+        self.t = t
+        self.first = None
+        self.second = None
+        self.reached = threading.Event()
+        self.release = threading.Event()
+
+    def check(self):
+        self.first = read_all(self.t)
+        self.reached.set()
+        self.release.wait()
+        self.second = read_all(self.t)
+        return True
+
+
+def run(*queries):
+    t = Transaction()
+    for q in queries:
+        t.add_query(q[0], grades_table, *q[1:])
+    return t.run()
+
+
+# 1: one snapshot held open while other transactions delete, update and reinsert
+t = Transaction('si')
+probe = Probe(t)
+t.add_query(probe.check, grades_table)
+th = threading.Thread(target=t.run)
+th.start()
+probe.reached.wait()
+for key in keys[:20]:
+    run((query.delete, key))
+run((query.delete_range, keys[20], keys[39]))
+run((query.delete_where, 2, lambda v: v == 4))
+for key in keys[40:60]:
+    run((query.update, key, None, None, None, 50, None))
+for key in keys[:10]:
+    run((query.insert, key, 0, 0, 99, 0))
+probe.release.set()
+th.join()
+rows1, cols1, sum1 = probe.first
+rows2, cols2, sum2 = probe.second
+for key in keys:
+    expect('repeatable read of key %d' % key, rows1[key] == rows2[key] and rows2[key] and len(rows2[key]) == 1)
+for value in range(5):
+    expect('repeatable read of column 2 = %d' % value, cols1[value] == cols2[value] and cols2[value] is not False)
+expect('repeatable range sum', sum1 == sum2 == number_of_records)
+print("Snapshot finished")
+
+# 2: first committer wins against a delete
+t = Transaction('si')
+probe = Probe(t)
+t.add_query(probe.check, grades_table)
+t.add_query(query.update, grades_table, keys[100], None, None, None, 7, None)
+result = []
+th = threading.Thread(target=lambda: result.append(t.run()))
+th.start()
+probe.reached.wait()
+run((query.delete, keys[100]))
+probe.release.set()
+th.join()
+expect('update of a record deleted after the snapshot aborted', result == [False])
+expect('the deleted record stayed deleted', query.select(keys[100], 0, [1, 1, 1, 1, 1]) == [])
+print("Conflict finished")
+
+# 3: readers and deleting writers running at the same time
+stop = threading.Event()
+errors = []
+reads = [0]
+
+
+def reader(seed):
+    while not stop.is_set():
+        t = Transaction('si')
+        probe = Probe(t)
+        probe.release.set()
+        t.add_query(probe.check, grades_table)
+        t.run()
+        reads[0] += 1
+        if probe.first != probe.second:
+            errors.append(seed)
+
+
+def writer(seed):
+    rnd = Random(seed)
+    for i in range(200):
+        key = rnd.choice(keys)
+        if rnd.random() < 0.5:
+            run((query.delete, key))
+        else:
+            run((query.insert, key, i, rnd.randrange(5), rnd.randrange(10), 0))
+
+
+readers = [threading.Thread(target=reader, args=(i,)) for i in range(2)]
+writers = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+for th in readers + writers:
+    th.start()
+for th in writers:
+    th.join()
+stop.set()
+for th in readers:
+    th.join()
+expect('%d snapshots read the same twice' % reads[0], not errors)
+print("Concurrent finished")
+
+print('Score', score, '/', total)